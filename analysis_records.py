@@ -0,0 +1,290 @@
+import json
+
+# Comp categories, in the order they are rendered; compact records store the index
+COMP_CATEGORIES = ('primary', 'thematic', 'genre', 'voice', 'trope')
+
+_COMP_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'title': {'type': 'string'},
+        'author': {'type': 'string'},
+        'year': {'type': 'integer', 'description': 'Publication year'},
+        'category': {'type': 'string', 'enum': list(COMP_CATEGORIES)},
+        'reason': {'type': 'string', 'description': '2-3 sentences on the similarities for this category'}
+    },
+    'required': ['title', 'author', 'year', 'category', 'reason']
+}
+
+# Function-calling schema for a chunk's comparable titles
+CHUNK_ANALYSIS_FUNCTION = {
+    'name': 'record_comparables',
+    'description': 'Record comparable titles for a manuscript excerpt',
+    'parameters': {
+        'type': 'object',
+        'properties': {'comps': {'type': 'array', 'items': _COMP_SCHEMA}},
+        'required': ['comps']
+    }
+}
+
+# Function-calling schema for a full (compiled) analysis
+ANALYSIS_FUNCTION = {
+    'name': 'record_analysis',
+    'description': 'Record the compiled manuscript analysis',
+    'parameters': {
+        'type': 'object',
+        'properties': {
+            'comps': {'type': 'array', 'items': _COMP_SCHEMA},
+            'score': {'type': 'integer', 'minimum': 1, 'maximum': 10, 'description': 'Commercial score'},
+            'strengths': {'type': 'array', 'items': {'type': 'string'}},
+            'weaknesses': {'type': 'array', 'items': {'type': 'string'}},
+            'genres': {'type': 'array', 'items': {'type': 'string'}, 'description': 'Primary genre first'},
+            'audience': {'type': 'string', 'description': 'Core target demographic'}
+        },
+        'required': ['comps', 'score', 'strengths', 'weaknesses', 'genres', 'audience']
+    }
+}
+
+# Function-calling schema for replacements of comps that are too old
+REPLACEMENTS_FUNCTION = {
+    'name': 'record_replacements',
+    'description': 'Record replacement comparable titles',
+    'parameters': {
+        'type': 'object',
+        'properties': {
+            'replacements': {
+                'type': 'array',
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'old_title': {'type': 'string'},
+                        'title': {'type': 'string'},
+                        'author': {'type': 'string'},
+                        'year': {'type': 'integer'},
+                        'reason': {'type': 'string'}
+                    },
+                    'required': ['old_title', 'title', 'author', 'year', 'reason']
+                }
+            }
+        },
+        'required': ['replacements']
+    }
+}
+
+# Explains the compact record keys to the compile prompt
+COMPACT_LEGEND = ("Each analysis is compact JSON: c = comparable titles as [title, author, year, category, reason] "
+                  "with category 0 primary, 1 thematic, 2 genre, 3 voice, 4 trope; s = commercial score; "
+                  "st = strengths; w = weaknesses; g = genres, primary first; a = target audience; n = notes.")
+
+_HEADINGS = {
+    'thematic': 'THEMATIC COMPARABLE',
+    'genre': 'GENRE COMPARABLE',
+    'voice': 'VOICE COMPARABLE',
+    'trope': 'TROPE COMPARABLE'
+}
+
+def parse_arguments(text):
+    """Decode a function call's JSON arguments, tolerating a ```json fence"""
+    text = text.strip()
+    if text.startswith('```'):
+        text = text.split('\n', 1)[-1].rsplit('```', 1)[0]
+    data = json.loads(text)
+    if not isinstance(data, dict):
+        raise ValueError("Expected a JSON object")
+    return data
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+class Comp:
+    """One comparable title"""
+
+    __slots__ = ('title', 'author', 'year', 'category', 'reason')
+
+    def __init__(self, title, author, year=None, category='primary', reason=''):
+        self.title = title
+        self.author = author
+        self.year = year
+        self.category = category if category in COMP_CATEGORIES else 'primary'
+        self.reason = reason
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(str(data.get('title', '')).strip(), str(data.get('author', '')).strip(),
+                   _int(data.get('year')), data.get('category'), str(data.get('reason', '')).strip())
+
+    def heading(self):
+        year = f" ({self.year})" if self.year else ''
+        return f"{self.title} by {self.author}{year}"
+
+    def to_compact(self):
+        return [self.title, self.author, self.year, COMP_CATEGORIES.index(self.category), self.reason]
+
+    @classmethod
+    def from_compact(cls, values):
+        title, author, year, category, reason = values
+        return cls(title, author, year, COMP_CATEGORIES[category], reason)
+
+class Analysis:
+    """A chunk or compiled analysis.
+
+    Chunk analyses only carry comps. ``notes`` holds the raw reply when the
+    model did not return JSON, so nothing is lost downstream.
+    """
+
+    __slots__ = ('comps', 'score', 'strengths', 'weaknesses', 'genres', 'audience', 'notes')
+
+    def __init__(self, comps=(), score=None, strengths=(), weaknesses=(), genres=(), audience='', notes=''):
+        self.comps = list(comps)
+        self.score = score
+        self.strengths = list(strengths)
+        self.weaknesses = list(weaknesses)
+        self.genres = list(genres)
+        self.audience = audience
+        self.notes = notes
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build from function-call arguments; unknown or malformed fields are ignored"""
+        comps = [Comp.from_dict(comp) for comp in data.get('comps') or [] if isinstance(comp, dict)]
+        return cls(
+            comps=[comp for comp in comps if comp.title],
+            score=_int(data.get('score')),
+            strengths=[str(item) for item in data.get('strengths') or []],
+            weaknesses=[str(item) for item in data.get('weaknesses') or []],
+            genres=[str(item) for item in data.get('genres') or []],
+            audience=str(data.get('audience') or '')
+        )
+
+    @classmethod
+    def from_reply(cls, reply):
+        """Parse a model reply, keeping it as notes if it is not valid JSON"""
+        try:
+            return cls.from_dict(parse_arguments(reply))
+        except ValueError:
+            return cls(notes=reply.strip())
+
+    def to_compact(self):
+        """Short-keyed dict with empty fields left out"""
+        compact = {
+            'c': [comp.to_compact() for comp in self.comps],
+            's': self.score,
+            'st': self.strengths,
+            'w': self.weaknesses,
+            'g': self.genres,
+            'a': self.audience,
+            'n': self.notes
+        }
+        return {key: value for key, value in compact.items() if value}
+
+    @classmethod
+    def from_compact(cls, compact):
+        return cls(
+            comps=[Comp.from_compact(values) for values in compact.get('c', [])],
+            score=compact.get('s'),
+            strengths=compact.get('st', []),
+            weaknesses=compact.get('w', []),
+            genres=compact.get('g', []),
+            audience=compact.get('a', ''),
+            notes=compact.get('n', '')
+        )
+
+    def dumps(self):
+        return json.dumps(self.to_compact(), separators=(',', ':'), ensure_ascii=False)
+
+    @classmethod
+    def loads(cls, text):
+        return cls.from_compact(json.loads(text))
+
+    def render(self):
+        """Text in the headed format the frontend displays"""
+        sections = []
+        primary = [comp for comp in self.comps if comp.category == 'primary']
+        if primary:
+            lines = ["PRIMARY COMPARABLE TITLES:",
+                     "These are the three most similar overall matches to the manuscript:"]
+            for number, comp in enumerate(primary, 1):
+                lines.append(f"\n{number}. {comp.heading()}\n   - {comp.reason}")
+            sections.append('\n'.join(lines))
+        for category in COMP_CATEGORIES[1:]:
+            for comp in self.comps:
+                if comp.category == category:
+                    sections.append(f"{_HEADINGS[category]}:\n{comp.heading()}\n- {comp.reason}")
+                    break
+        if self.score:
+            sections.append(f"COMMERCIAL SCORE: {self.score}/10")
+        if self.strengths:
+            sections.append("STRENGTHS:\n" + '\n'.join(f"- {item}" for item in self.strengths))
+        if self.weaknesses:
+            sections.append("WEAKNESSES:\n" + '\n'.join(f"- {item}" for item in self.weaknesses))
+        if self.genres:
+            lines = [f"- Primary: {self.genres[0]}"]
+            if len(self.genres) > 1:
+                lines.append(f"- Secondary: {', '.join(self.genres[1:])}")
+            sections.append("GENRES:\n" + '\n'.join(lines))
+        if self.audience:
+            sections.append(f"TARGET AUDIENCE:\n- {self.audience}")
+        if self.notes:
+            sections.append(self.notes)
+        return '\n\n'.join(sections)
+
+class JSONMemberStream:
+    """Incrementally read a streamed JSON object, yielding each top-level member once complete.
+
+    A member is complete when the next top-level comma arrives (or at
+    ``close``), so the prefix up to it parses as an object on its own.
+    """
+
+    def __init__(self):
+        self.buffer = []
+        self.length = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.emitted = 0
+
+    def _members(self, end):
+        try:
+            data = parse_arguments(''.join(self.buffer)[:end].rstrip().rstrip(',') + '}')
+        except ValueError:
+            return []
+        members = list(data.items())[self.emitted:]
+        self.emitted += len(members)
+        return members
+
+    def feed(self, fragment):
+        completed = []
+        for char in fragment:
+            self.length += 1
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in '{[':
+                self.depth += 1
+            elif char in '}]':
+                self.depth -= 1
+            elif char == ',' and self.depth == 1:
+                self.buffer.append(fragment)
+                completed.extend(self._members(self.length))
+                self.buffer.pop()
+        self.buffer.append(fragment)
+        return completed
+
+    def close(self):
+        """Members still pending once the stream has ended"""
+        text = ''.join(self.buffer).rstrip()
+        try:
+            data = parse_arguments(text)
+        except ValueError:
+            return []
+        members = list(data.items())[self.emitted:]
+        self.emitted += len(members)
+        return members
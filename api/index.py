@@ -1,12 +1,15 @@
 from flask import Flask, request, render_template, jsonify
 import os
-import json
-import requests
+import sys
 from dotenv import load_dotenv
 
 # Get the directory containing the script
 script_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# Share the LLM client with app.py
+sys.path.insert(0, script_dir)
+from llm_client import LLMError, get_client
+
 # Look for .env file
 env_path = os.path.join(script_dir, '.env')
 print(f"Looking for .env file in: {env_path}")
@@ -26,20 +29,8 @@ def analyze_text(text):
         return "Error: API base URL not set. Please add the base URL to the .env file."
 
     try:
-        headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'User-Agent': 'ManuscriptAnalysis/1.0',
-            'X-Organization-ID': os.getenv('OPENAI_ORG_ID', '')
-        }
-
-        session = requests.Session()
-        api_endpoint = f"{base_url}/v1/chat/completions"
-
-        data = {
-            'model': 'gpt-4',
-            'messages': [
+        return get_client().chat(
+            [
                 {'role': 'system', 'content': 'You are a professional literary agent and publishing expert.'},
                 {'role': 'user', 'content': f'''Analyze the following query letter or excerpt and provide a detailed analysis in the following format:
 
@@ -78,35 +69,10 @@ def analyze_text(text):
         {text}
         '''}
             ],
-            'temperature': 0.7,
-            'max_tokens': 2000
-        }
-
-        response = session.post(
-            api_endpoint,
-            headers=headers,
-            json=data,
-            timeout=30
+            max_tokens=2000
         )
-
-        if response.status_code != 200:
-            error_msg = f"API Error: Status {response.status_code}"
-            try:
-                error_data = response.json()
-                if 'error' in error_data:
-                    error_msg += f" - {error_data['error'].get('message', '')}"
-                else:
-                    error_msg += f" - {json.dumps(error_data)}"
-            except:
-                error_msg += f" - {response.text}"
-            return error_msg
-
-        response_data = response.json()
-        if 'choices' in response_data and len(response_data['choices']) > 0:
-            return response_data['choices'][0]['message']['content']
-        else:
-            return "Error: Unexpected response format from API"
-
+    except LLMError as e:
+        return str(e)
     except Exception as e:
         return f"Error: {str(e)}"
 
@@ -1,83 +1,430 @@
-from flask import Flask, request, render_template, jsonify
+import time
+# Start of the import, for the startup report
+_import_started = time.perf_counter()
+from flask import Flask, Response, g, request, render_template, jsonify, stream_with_context
 import os
-import requests
 from dotenv import load_dotenv
 import sys
 import json
 from datetime import datetime
-from pymongo import MongoClient
-from bson import json_util
-import traceback
-import PyPDF2
-import tiktoken
+from pymongo import MongoClient, ASCENDING, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from werkzeug.exceptions import RequestEntityTooLarge
+from bson import ObjectId
+from bson.errors import InvalidId
+import logging
+import contextvars
+import re
+import secrets
+import csv
+import base64
 import io
+import shutil
+import tempfile
+import uuid
+import atexit
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cache import AnalysisCache, hash_text, make_cache_key
+from comps_catalog import CompsCatalog, normalize_title
+from analysis_records import (ANALYSIS_FUNCTION, CHUNK_ANALYSIS_FUNCTION, COMPACT_LEGEND, REPLACEMENTS_FUNCTION,
+                              Analysis, Comp, JSONMemberStream, parse_arguments)
+from dedup import drop_repeated_paragraphs, find_duplicate_chunks, normalize_manuscript, strip_repeated_lines
+from pdf_extract import extract_page, extract_page_range
+from llm_client import count_tokens, get_client, get_encoding
+from write_behind import WriteBehindBuffer
+import metrics
+from structured_logging import new_request_id, request_id_var, setup_logging
+# PyPDF2, requests, tiktoken and the process pool machinery are imported on
+# first use (or by warm_up) so that importing the app stays fast
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Debug prints for environment setup
-print("Environment Setup:")
-print(f"OPENAI_API_KEY exists: {bool(os.getenv('OPENAI_API_KEY'))}")
-print(f"OPENAI_BASE_URL exists: {bool(os.getenv('OPENAI_BASE_URL'))}")
-print(f"OPENAI_ORG_ID exists: {bool(os.getenv('OPENAI_ORG_ID'))}")
-print(f"MONGODB_URI exists: {bool(os.getenv('MONGODB_URI'))}")
+setup_logging()
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-def get_db():
-    """Get MongoDB connection, creating it if necessary"""
+@app.before_request
+def assign_request_id():
+    g.request_id_token = request_id_var.set(request.headers.get('X-Request-ID') or new_request_id())
+
+@app.after_request
+def add_request_id_header(response):
+    response.headers['X-Request-ID'] = request_id_var.get()
+    return response
+
+@app.teardown_request
+def clear_request_id(exc=None):
+    if 'request_id_token' in g:
+        request_id_var.reset(g.request_id_token)
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.metrics_started = time.perf_counter()
+    metrics.HTTP_REQUESTS_IN_FLIGHT.inc(endpoint=g.metrics_endpoint)
+
+@app.after_request
+def record_request_metrics(response):
+    if 'metrics_started' in g:
+        metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g.metrics_started,
+                                             endpoint=g.metrics_endpoint,
+                                             status=response.status_code)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc=None):
+    if 'metrics_endpoint' in g:
+        metrics.HTTP_REQUESTS_IN_FLIGHT.dec(endpoint=g.metrics_endpoint)
+
+# Maximum number of chunks analyzed in parallel by analyze_text
+ANALYSIS_CONCURRENCY = int(os.getenv('ANALYSIS_CONCURRENCY', '4'))
+
+# Number of background workers running analysis jobs in this process
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+# Days a job document (with its rendered result) is kept
+JOBS_TTL_DAYS = float(os.getenv('JOBS_TTL_DAYS', '7'))
+# A queued or running job not updated for this long is reported as failed
+JOB_STALE_SECONDS = float(os.getenv('JOB_STALE_SECONDS', '1800'))
+
+# MongoDB connection pool settings
+MONGODB_MAX_POOL_SIZE = int(os.getenv('MONGODB_MAX_POOL_SIZE', '50'))
+MONGODB_HEALTH_CHECK_INTERVAL = float(os.getenv('MONGODB_HEALTH_CHECK_INTERVAL', '30'))
+# After a failed connection, MongoDB is not retried (callers fail fast) for this many seconds
+MONGODB_RETRY_SECONDS = float(os.getenv('MONGODB_RETRY_SECONDS', '30'))
+
+# Page size limits for /subscribers
+SUBSCRIBERS_PAGE_SIZE = 100
+SUBSCRIBERS_MAX_PAGE_SIZE = 1000
+
+# Addresses written per bulk_write call by /subscribers/import
+SUBSCRIBER_IMPORT_BATCH_SIZE = 1000
+
+# Write-behind mode for /subscribe: acknowledge immediately, write in batches
+SUBSCRIBE_WRITE_BEHIND = os.getenv('SUBSCRIBE_WRITE_BEHIND', 'false').lower() == 'true'
+SUBSCRIBE_SPILL_DIR = os.getenv('SUBSCRIBE_SPILL_DIR', os.path.join(tempfile.gettempdir(), 'greenlight-spill'))
+SUBSCRIBE_FLUSH_SIZE = int(os.getenv('SUBSCRIBE_FLUSH_SIZE', '500'))
+SUBSCRIBE_FLUSH_INTERVAL = float(os.getenv('SUBSCRIBE_FLUSH_INTERVAL', '2'))
+
+# Uploads larger than this are spooled to a temporary file instead of memory
+PDF_SPOOL_MAX_BYTES = int(os.getenv('PDF_SPOOL_MAX_BYTES', str(5 * 1024 * 1024)))
+
+# PDFs with at least this many pages are extracted across a process pool
+PDF_PARALLEL_PAGE_THRESHOLD = int(os.getenv('PDF_PARALLEL_PAGE_THRESHOLD', '50'))
+PDF_EXTRACT_PROCESSES = int(os.getenv('PDF_EXTRACT_PROCESSES', str(os.cpu_count() or 1)))
+# Pages whose extraction takes longer than this much CPU time are reported
+PDF_SLOW_PAGE_SECONDS = float(os.getenv('PDF_SLOW_PAGE_SECONDS', '0.5'))
+
+# Admission control: uploads over MAX_UPLOAD_BYTES, PDFs over MAX_PDF_PAGES and
+# documents estimated at over MAX_DOCUMENT_TOKENS are rejected with a 413
+# before extraction. At most MAX_INFLIGHT_ANALYSES analyses run at once in a
+# process; requests past that get a 429 asking them to retry after
+# ADMISSION_RETRY_AFTER_SECONDS. Job mode runs JOB_WORKERS jobs at a time and
+# gets the same 429 once MAX_QUEUED_JOBS jobs are queued or running. The
+# ASGI app (async_app.py) holds no thread per analysis, so it has its own,
+# much larger MAX_INFLIGHT_ASYNC_ANALYSES cap.
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', str(20 * 1024 * 1024)))
+MAX_PDF_PAGES = int(os.getenv('MAX_PDF_PAGES', '800'))
+MAX_DOCUMENT_TOKENS = int(os.getenv('MAX_DOCUMENT_TOKENS', '400000'))
+MAX_INFLIGHT_ANALYSES = int(os.getenv('MAX_INFLIGHT_ANALYSES', '8'))
+MAX_INFLIGHT_ASYNC_ANALYSES = int(os.getenv('MAX_INFLIGHT_ASYNC_ANALYSES', '256'))
+MAX_QUEUED_JOBS = int(os.getenv('MAX_QUEUED_JOBS', '16'))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv('ADMISSION_RETRY_AFTER_SECONDS', '30'))
+# Pages sampled to estimate a PDF's token count before extracting all of it
+ADMISSION_SAMPLE_PAGES = 5
+# Rough characters per token for English prose, for estimates without tokenizing
+CHARS_PER_TOKEN = 4
+
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+UPLOAD_TOO_LARGE_MESSAGE = f"Upload exceeds the {round(MAX_UPLOAD_BYTES / (1024 * 1024), 1):g}MB limit"
+
+# Chunking: tokens shared between consecutive chunks, and whether chunk ends
+# are moved back to the nearest paragraph or sentence break
+CHUNK_OVERLAP_TOKENS = int(os.getenv('CHUNK_OVERLAP_TOKENS', '0'))
+CHUNK_SNAP_TO_BREAKS = os.getenv('CHUNK_SNAP_TO_BREAKS', 'true').lower() == 'true'
+# Fraction of a chunk, counted back from its end, searched for a break
+CHUNK_SNAP_WINDOW = 0.15
+
+# Pre-analysis cleanup: strip headers/footers repeated across PDF pages, drop
+# repeated paragraphs, and skip chunks at least DEDUP_THRESHOLD similar
+# (estimated Jaccard) to an earlier one
+DEDUP_ENABLED = os.getenv('DEDUP_ENABLED', 'true').lower() == 'true'
+DEDUP_THRESHOLD = float(os.getenv('DEDUP_THRESHOLD', '0.9'))
+
+# Largest compile prompt input, in tokens; bigger inputs are reduced in groups
+COMPILE_INPUT_TOKEN_BUDGET = int(os.getenv('COMPILE_INPUT_TOKEN_BUDGET', '6000'))
+
+# Bump whenever the analysis prompts change so cached results are invalidated
+PROMPT_VERSION = 4
+
+# 'recent' comparable titles must be at most this many years old
+RECENT_COMPS_YEARS = int(os.getenv('RECENT_COMPS_YEARS', '5'))
+
+# Catalog of known titles used to verify comp years and suggest recent replacements
+COMPS_CATALOG_PATH = os.getenv('COMPS_CATALOG_PATH',
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'comps_catalog.json'))
+
+# Days a stored analysis stays fetchable from /results/<id>
+ANALYSES_TTL_DAYS = float(os.getenv('ANALYSES_TTL_DAYS', '30'))
+
+# Analysis result cache settings
+ANALYSIS_CACHE_ENABLED = os.getenv('ANALYSIS_CACHE_ENABLED', 'true').lower() == 'true'
+ANALYSIS_CACHE_SIZE = int(os.getenv('ANALYSIS_CACHE_SIZE', '256'))
+ANALYSIS_CACHE_TTL_HOURS = float(os.getenv('ANALYSIS_CACHE_TTL_HOURS', '168'))
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Records the latency of every MongoDB command the client runs"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.MONGODB_COMMAND_SECONDS.observe(event.duration_micros / 1e6,
+                                                command=event.command_name, outcome='success')
+
+    def failed(self, event):
+        metrics.MONGODB_COMMAND_SECONDS.observe(event.duration_micros / 1e6,
+                                                command=event.command_name, outcome='failure')
+
+_mongo_client = None
+_mongo_client_pid = None
+_mongo_last_check = 0.0
+_mongo_unavailable_until = 0.0
+_mongo_lock = threading.Lock()
+
+def _connect_mongo():
+    """Create a MongoClient and verify it with a single ping"""
+    mongodb_uri = os.getenv('MONGODB_URI')
+    if not mongodb_uri:
+        error_msg = "Error: MONGODB_URI not set in environment variables"
+        logger.error(error_msg)
+        raise Exception(error_msg)
+
+    logger.info("Connecting to MongoDB")
+    client = MongoClient(mongodb_uri,
+                         maxPoolSize=MONGODB_MAX_POOL_SIZE,
+                         event_listeners=[MongoCommandTimer()],
+                         serverSelectionTimeoutMS=5000,
+                         connectTimeoutMS=5000,
+                         socketTimeoutMS=5000)
     try:
-        mongodb_uri = os.getenv('MONGODB_URI')
-        if not mongodb_uri:
-            error_msg = "Error: MONGODB_URI not set in environment variables"
-            print(error_msg)
-            raise Exception(error_msg)
-
-        print(f"Attempting to connect to MongoDB with URI starting with: {mongodb_uri[:20]}...")
-        client = MongoClient(mongodb_uri, 
-                           serverSelectionTimeoutMS=5000,
-                           connectTimeoutMS=5000,
-                           socketTimeoutMS=5000)
-        
-        # Force a connection attempt to verify it works
         client.admin.command('ping')
-        db = client.manuscript_analysis
-        print("MongoDB connected successfully")
-        return db
+    except Exception:
+        client.close()
+        raise
+    logger.info("MongoDB connected")
+    ensure_indexes(client.manuscript_analysis)
+    return client
+
+def ensure_indexes(db):
+    """Create the indexes the app's queries rely on (a no-op when they exist)"""
+    try:
+        # Serves the active-subscriber filter and the (timestamp, _id) page order without a sort
+        db.subscribers.create_index([('status', ASCENDING), ('timestamp', ASCENDING), ('_id', ASCENDING)],
+                                    name='status_timestamp_id')
+        if 'status_timestamp' in db.subscribers.index_information():
+            # Superseded by status_timestamp_id, which has it as a prefix
+            db.subscribers.drop_index('status_timestamp')
+        # The unique index can only be built once older documents are backfilled and merged
+        backfill_normalized_emails(db)
+        db.subscribers.create_index('email_normalized', name='email_normalized_unique', unique=True,
+                                    partialFilterExpression={'email_normalized': {'$type': 'string'}})
+        # Finds an earlier stored analysis of the same text; _id serves /results/<id>
+        db.analyses.create_index([('text_hash', ASCENDING), ('time_range', ASCENDING),
+                                  ('prompt_version', ASCENDING), ('created_at', ASCENDING)],
+                                 name='text_hash_lookup')
+        db.analyses.create_index('created_at', name='created_at_ttl',
+                                 expireAfterSeconds=int(ANALYSES_TTL_DAYS * 86400))
+        db.jobs.create_index('created_at', name='created_at_ttl', expireAfterSeconds=int(JOBS_TTL_DAYS * 86400))
+    except Exception as e:
+        logger.exception("Error creating MongoDB indexes")
+
+def backfill_normalized_emails(db):
+    """Set email_normalized on subscribers that predate it, merging duplicates.
+
+    Each group of documents with the same normalized address keeps its
+    earliest signup, active if any of them was; the rest are deleted. Runs
+    once per database, recorded in the migrations collection.
+    """
+    if db.migrations.find_one({'_id': 'subscribers_email_normalized'}):
+        return
+
+    groups = {}
+    fields = {'email': 1, 'email_normalized': 1, 'timestamp': 1, 'status': 1}
+    for doc in db.subscribers.find({}, fields).sort('timestamp', ASCENDING):
+        email = doc.get('email_normalized') or normalize_email(str(doc.get('email') or ''))
+        if email:
+            groups.setdefault(email, []).append(doc)
+
+    deletes = []
+    updates = []
+    for email, docs in groups.items():
+        keeper, duplicates = docs[0], docs[1:]
+        update = {}
+        if keeper.get('email_normalized') != email:
+            update['email_normalized'] = email
+        if keeper.get('status') != 'active' and any(doc.get('status') == 'active' for doc in duplicates):
+            update['status'] = 'active'
+        if update:
+            updates.append(UpdateOne({'_id': keeper['_id']}, {'$set': update}))
+        deletes.extend(doc['_id'] for doc in duplicates)
+
+    # Duplicates go first, so no keeper's new email_normalized clashes with one still present
+    for start in range(0, len(deletes), SUBSCRIBER_IMPORT_BATCH_SIZE):
+        db.subscribers.delete_many({'_id': {'$in': deletes[start:start + SUBSCRIBER_IMPORT_BATCH_SIZE]}})
+    for start in range(0, len(updates), SUBSCRIBER_IMPORT_BATCH_SIZE):
+        db.subscribers.bulk_write(updates[start:start + SUBSCRIBER_IMPORT_BATCH_SIZE])
+
+    db.migrations.update_one({'_id': 'subscribers_email_normalized'},
+                             {'$set': {'completed_at': datetime.now()}}, upsert=True)
+    logger.info("Backfilled normalized subscriber emails",
+                extra={'updated': len(updates), 'merged': len(deletes)})
+
+def _connect_mongo_or_back_off(now):
+    # Called with _mongo_lock held
+    global _mongo_unavailable_until
+    if now < _mongo_unavailable_until:
+        raise Exception(f"MongoDB unavailable, retrying in {_mongo_unavailable_until - now:.0f}s")
+    try:
+        return _connect_mongo()
+    except Exception:
+        _mongo_unavailable_until = now + MONGODB_RETRY_SECONDS
+        raise
+
+def get_mongo_client():
+    """Get the process-wide MongoClient, creating it if necessary.
+
+    The client is recreated after a fork, and is pinged at most once every
+    MONGODB_HEALTH_CHECK_INTERVAL seconds; a failed ping reconnects. After a
+    failed connection, calls raise at once for MONGODB_RETRY_SECONDS instead
+    of each waiting out the connection timeouts.
+    """
+    global _mongo_client, _mongo_client_pid, _mongo_last_check
+    with _mongo_lock:
+        pid = os.getpid()
+        if _mongo_client is not None and _mongo_client_pid != pid:
+            # Inherited from the parent process; its sockets are not ours to use
+            _mongo_client = None
+
+        now = time.monotonic()
+        if _mongo_client is None:
+            _mongo_client = _connect_mongo_or_back_off(now)
+            _mongo_client_pid = pid
+            _mongo_last_check = now
+        elif now - _mongo_last_check >= MONGODB_HEALTH_CHECK_INTERVAL:
+            try:
+                _mongo_client.admin.command('ping')
+            except Exception as e:
+                logger.warning("MongoDB health check failed, reconnecting: %s", e)
+                _mongo_client.close()
+                _mongo_client = None
+                _mongo_client = _connect_mongo_or_back_off(now)
+            _mongo_last_check = now
+        return _mongo_client
+
+def close_mongo_client():
+    """Close the process-wide MongoClient, if this process owns one"""
+    global _mongo_client
+    with _mongo_lock:
+        if _mongo_client is not None and _mongo_client_pid == os.getpid():
+            _mongo_client.close()
+        _mongo_client = None
+
+atexit.register(close_mongo_client)
+
+def _analysis_cache_collection():
+    # Skip the persistent tier entirely when MongoDB is not configured
+    if not os.getenv('MONGODB_URI'):
+        return None
+    return get_mongo_client().manuscript_analysis.analysis_cache
+
+analysis_cache = AnalysisCache(
+    collection_getter=_analysis_cache_collection,
+    maxsize=ANALYSIS_CACHE_SIZE,
+    ttl_seconds=ANALYSIS_CACHE_TTL_HOURS * 3600,
+    retry_seconds=MONGODB_RETRY_SECONDS
+)
+
+comps_catalog = CompsCatalog.load(COMPS_CATALOG_PATH)
+
+def get_db():
+    """Get the manuscript_analysis database from the shared MongoDB client"""
+    try:
+        return get_mongo_client().manuscript_analysis
     except Exception as e:
-        error_msg = f"Error connecting to MongoDB: {str(e)}\nType: {type(e)}"
-        print(error_msg)
-        traceback.print_exc()
+        logger.exception("Error connecting to MongoDB")
         raise  # Re-raise the exception to be caught by the caller
 
+def mask_email(email):
+    """Email with the local part hidden, safe to put in logs"""
+    local, _, domain = email.partition('@')
+    return f"{local[:1]}***@{domain}" if domain else '***'
+
+def normalize_email(email):
+    """Canonical form of an email address used for deduplication"""
+    return email.strip().lower()
+
+def is_valid_email(email):
+    """Basic email validation"""
+    return '@' in email and '.' in email
+
+def subscriber_upsert(email, timestamp, reactivate=True):
+    """Filter and update for upserting a subscriber keyed on the normalized email.
+
+    New addresses are inserted as active, so retries and double submissions
+    never create duplicates. Existing ones are reactivated only with
+    ``reactivate`` (an explicit subscribe), never by an import.
+    """
+    email = email.strip()
+    fields = {
+        'email': email,
+        'email_normalized': normalize_email(email),
+        'timestamp': timestamp
+    }
+    if not reactivate:
+        return {'email_normalized': normalize_email(email)}, {'$setOnInsert': dict(fields, status='active')}
+    return {'email_normalized': normalize_email(email)}, {'$setOnInsert': fields, '$set': {'status': 'active'}}
+
 def save_email(email):
     try:
-        print(f"Attempting to save email: {email}")
-        
-        # Get fresh DB connection
         db = get_db()  # This may raise an exception now
         if db is None:
             error_msg = "Could not connect to MongoDB. URI exists: " + str(bool(os.getenv('MONGODB_URI')))
-            print(f"Error: {error_msg}")
+            logger.error(error_msg)
             raise Exception(error_msg)
-            
-        result = db.subscribers.insert_one({
-            'email': email,
-            'timestamp': datetime.utcnow(),
-            'status': 'active'
-        })
-        
-        success = bool(result.inserted_id)
-        print(f"Email save {'successful' if success else 'failed'}")
-        if not success:
-            raise Exception("Failed to get inserted_id from MongoDB")
-        return success
-    except Exception as e:
-        error_msg = f"Error saving email: {str(e)}\nType: {type(e)}"
-        print(error_msg)
-        traceback.print_exc()
+
+        try:
+            result = db.subscribers.update_one(*subscriber_upsert(email, datetime.utcnow()), upsert=True)
+            logger.info("Subscriber saved", extra={'email': mask_email(email),
+                                                   'new': bool(result.upserted_id), 'sample': True})
+        except DuplicateKeyError:
+            # A concurrent request inserted the same address first
+            logger.info("Subscriber saved", extra={'email': mask_email(email), 'new': False, 'sample': True})
+        return True
+    except Exception:
+        logger.exception("Error saving email", extra={'email': mask_email(email)})
         raise  # Re-raise the exception to be caught by the caller
 
+def flush_subscribers(records):
+    """Write buffered subscriptions to MongoDB (idempotent, so replays are safe)"""
+    entries = [(record['email'], datetime.fromisoformat(record['timestamp'])) for record in records]
+    # These are /subscribe requests, so they reactivate like save_email does
+    inserted, duplicates = bulk_import_subscribers(get_db(), entries, reactivate=True)
+    logger.info("Flushed buffered subscriptions",
+                extra={'records': len(records), 'inserted': inserted, 'duplicates': duplicates})
+
+subscriber_buffer = WriteBehindBuffer(
+    flush_subscribers,
+    SUBSCRIBE_SPILL_DIR,
+    'subscribers',
+    max_batch=SUBSCRIBE_FLUSH_SIZE,
+    flush_interval=SUBSCRIBE_FLUSH_INTERVAL
+)
+atexit.register(subscriber_buffer.close)
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -87,373 +434,573 @@ def subscribe():
     try:
         data = request.get_json()
         if not data or 'email' not in data:
-            print("Error: Invalid request data - missing email")
+            logger.info("Subscribe rejected: missing email")
             return jsonify({'success': False, 'message': 'Email is required'}), 400
         
         email = data['email']
-        print(f"Received subscription request for email: {email}")
         
         # Basic email validation
-        if '@' not in email or '.' not in email:
-            print(f"Error: Invalid email format - {email}")
+        if not is_valid_email(email):
+            logger.info("Subscribe rejected: invalid email", extra={'email': mask_email(email)})
             return jsonify({'success': False, 'message': 'Invalid email format'}), 400
         
+        if SUBSCRIBE_WRITE_BEHIND:
+            subscriber_buffer.add({'email': email, 'timestamp': datetime.utcnow().isoformat()})
+            return jsonify({'success': True, 'message': 'Thank you for subscribing!'})
+
         if save_email(email):
-            print(f"Successfully subscribed email: {email}")
             return jsonify({'success': True, 'message': 'Thank you for subscribing!'})
         else:
             db = get_db()
             error_msg = "Failed to save email. Database connected: " + str(db is not None)
-            print(f"Error: {error_msg}")
+            logger.error(error_msg)
             return jsonify({'success': False, 'message': error_msg}), 500
     except Exception as e:
         error_msg = f"Subscribe error: {str(e)}\nType: {type(e)}"
-        print(error_msg)
-        traceback.print_exc()
+        logger.exception("Subscribe error")
         # For debugging, return the actual error message
         return jsonify({'success': False, 'message': error_msg}), 500
 
-def process_pdf(file):
-    """Process PDF file and extract text"""
+def spool_upload(file, copy=False):
+    """Return a seekable binary stream for an upload without reading it into memory.
+
+    Seekable streams are used as-is unless ``copy`` is set (e.g. when the
+    stream must outlive the request). Anything else is copied in 1MB blocks
+    into a SpooledTemporaryFile that rolls over to disk past PDF_SPOOL_MAX_BYTES.
+    """
+    stream = getattr(file, 'stream', file)
+    if not copy and stream.seekable():
+        stream.seek(0)
+        return stream
+
+    spooled = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_BYTES)
+    shutil.copyfileobj(stream, spooled, 1024 * 1024)
+    spooled.seek(0)
+    return spooled
+
+class AdmissionRejected(Exception):
+    """A request turned away before analysis, with the HTTP status to answer with"""
+
+    def __init__(self, message, status_code, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    def response(self):
+        body = {'error': str(self)}
+        headers = {}
+        if self.retry_after is not None:
+            body['retryAfter'] = self.retry_after
+            headers['Retry-After'] = str(self.retry_after)
+        return jsonify(body), self.status_code, headers
+
+@app.errorhandler(AdmissionRejected)
+def admission_rejected(e):
+    return e.response()
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    metrics.ADMISSION_REJECTED.inc(reason='size')
+    return jsonify({'error': UPLOAD_TOO_LARGE_MESSAGE}), 413
+
+_analysis_slots = threading.BoundedSemaphore(max(MAX_INFLIGHT_ANALYSES, 1))
+
+def acquire_analysis_slot(slots=_analysis_slots):
+    """Claim one of the MAX_INFLIGHT_ANALYSES slots (or of ``slots``) without waiting, or raise a 429.
+
+    The caller must call release_analysis_slot with the same ``slots`` once
+    the analysis is done.
+    """
+    if not slots.acquire(blocking=False):
+        metrics.ADMISSION_REJECTED.inc(reason='busy')
+        raise AdmissionRejected('Too many analyses in progress, please retry shortly', 429,
+                                retry_after=ADMISSION_RETRY_AFTER_SECONDS)
+    metrics.ANALYSES_IN_FLIGHT.inc()
+
+def release_analysis_slot(slots=_analysis_slots):
+    metrics.ANALYSES_IN_FLIGHT.dec()
+    slots.release()
+
+def check_text_admission(text):
+    """Reject text estimated at more than MAX_DOCUMENT_TOKENS"""
+    estimated_tokens = len(text) // CHARS_PER_TOKEN
+    if estimated_tokens > MAX_DOCUMENT_TOKENS:
+        metrics.ADMISSION_REJECTED.inc(reason='tokens')
+        raise AdmissionRejected(f'Document is too long: about {estimated_tokens} tokens, '
+                                f'the limit is {MAX_DOCUMENT_TOKENS}', 413)
+
+def check_pdf_admission(stream):
+    """Reject a PDF over MAX_PDF_PAGES, or estimated at over MAX_DOCUMENT_TOKENS, before extracting it.
+
+    Only the page tree and ADMISSION_SAMPLE_PAGES evenly spaced pages are
+    read; the stream is rewound afterwards.
+    """
+    import PyPDF2
+
     try:
-        # Read PDF file
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(file.read()))
-        text = ""
-        
-        # Extract text from all pages
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-            
-        return text.strip()
+        pdf_reader = PyPDF2.PdfReader(stream)
+        page_count = len(pdf_reader.pages)
+    except Exception as e:
+        raise AdmissionRejected(f'Could not read PDF: {str(e)}', 400)
+
+    if page_count > MAX_PDF_PAGES:
+        metrics.ADMISSION_REJECTED.inc(reason='pages')
+        raise AdmissionRejected(f'PDF has {page_count} pages, the limit is {MAX_PDF_PAGES}', 413)
+
+    if page_count:
+        sample = sorted({number * page_count // ADMISSION_SAMPLE_PAGES for number in range(ADMISSION_SAMPLE_PAGES)})
+        sample_chars = sum(len(extract_page(pdf_reader.pages[number])[0]) for number in sample)
+        estimated_tokens = sample_chars * page_count // (len(sample) * CHARS_PER_TOKEN)
+        if estimated_tokens > MAX_DOCUMENT_TOKENS:
+            metrics.ADMISSION_REJECTED.inc(reason='tokens')
+            raise AdmissionRejected(f'PDF is too long: about {estimated_tokens} tokens, '
+                                    f'the limit is {MAX_DOCUMENT_TOKENS}', 413)
+    stream.seek(0)
+    return page_count
+
+_pdf_executor = None
+_pdf_executor_pid = None
+_pdf_executor_lock = threading.Lock()
+
+def get_pdf_executor():
+    """Get this process's PDF extraction pool, creating it if necessary"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    global _pdf_executor, _pdf_executor_pid
+    with _pdf_executor_lock:
+        if _pdf_executor is None or _pdf_executor_pid != os.getpid():
+            # Spawn rather than fork: the parent is multi-threaded
+            _pdf_executor = ProcessPoolExecutor(
+                max_workers=PDF_EXTRACT_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            _pdf_executor_pid = os.getpid()
+        return _pdf_executor
+
+def _iter_pages_parallel(stream, page_count):
+    # Workers open the PDF themselves, so they need it on disk
+    with tempfile.NamedTemporaryFile(suffix='.pdf') as pdf_copy:
+        shutil.copyfileobj(stream, pdf_copy, 1024 * 1024)
+        pdf_copy.flush()
+
+        batch_size = max(1, -(-page_count // (PDF_EXTRACT_PROCESSES * 4)))
+        starts = range(0, page_count, batch_size)
+        ends = [min(start + batch_size, page_count) for start in starts]
+        paths = [pdf_copy.name] * len(starts)
+        # map() yields batches in submission order, which keeps the pages in order
+        for batch in get_pdf_executor().map(extract_page_range, paths, starts, ends):
+            yield from batch
+
+def iter_pdf_pages(file):
+    """Yield (text, cpu_seconds) for each PDF page lazily, in page order.
+
+    PDFs with PDF_PARALLEL_PAGE_THRESHOLD or more pages are split into page
+    ranges extracted by a process pool.
+    """
+    import PyPDF2
+
+    stream = spool_upload(file)
+    pdf_reader = PyPDF2.PdfReader(stream)
+    page_count = len(pdf_reader.pages)
+
+    if PDF_EXTRACT_PROCESSES > 1 and page_count >= PDF_PARALLEL_PAGE_THRESHOLD:
+        stream.seek(0)
+        yield from _iter_pages_parallel(stream, page_count)
+        return
+
+    for page in pdf_reader.pages:
+        yield extract_page(page)
+
+def report_page_timings(timings):
+    """Log total extraction CPU time and any pathologically slow pages"""
+    slow_pages = [(number, seconds) for number, seconds in enumerate(timings, 1)
+                  if seconds >= PDF_SLOW_PAGE_SECONDS]
+    for seconds in timings:
+        metrics.PDF_PAGE_CPU_SECONDS.observe(seconds)
+    logger.info("Extracted PDF pages", extra={'pages': len(timings), 'cpu_seconds': round(sum(timings), 3)})
+    for number, seconds in slow_pages:
+        logger.warning("Slow PDF page", extra={'page': number, 'cpu_seconds': round(seconds, 3)})
+
+def process_pdf(file, details=None):
+    """Process PDF file and extract text.
+
+    Tokens saved by stripping repeated headers and footers are recorded as
+    ``details['tokens_saved']``, which the analysis adds to its own savings.
+    """
+    try:
+        pages = []
+        timings = []
+        with metrics.PDF_EXTRACTION_SECONDS.time():
+            for text, cpu_seconds in iter_pdf_pages(file):
+                pages.append(text)
+                timings.append(cpu_seconds)
+
+        report_page_timings(timings)
+        if DEDUP_ENABLED:
+            pages, removed = strip_repeated_lines(pages)
+            if removed:
+                tokens_saved = count_tokens("\n".join(removed))
+                metrics.DEDUP_TOKENS_SAVED.inc(tokens_saved, stage='boilerplate')
+                if details is not None:
+                    details['tokens_saved'] = tokens_saved
+                logger.info("Stripped repeated header and footer lines",
+                            extra={'lines': len(removed), 'tokens_saved': tokens_saved})
+        return "\n".join(pages).strip()
     except Exception as e:
-        print(f"Error processing PDF: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error processing PDF")
         raise
 
-def split_text_into_chunks(text, max_tokens=3000):
-    """Split text into chunks that won't exceed token limit"""
-    encoding = tiktoken.encoding_for_model("gpt-4")
+_SENTENCE_ENDINGS = (b'.', b'!', b'?', b'."', b'!"', b'?"', b".'", b"!'", b"?'")
+
+def _find_chunk_break(encoding, tokens, lower, upper):
+    """Return the index just past the best break in tokens[lower:upper].
+
+    A paragraph break wins over a sentence end; if neither is found the
+    chunk is cut at ``upper``.
+    """
+    sentence_end = None
+    for index in range(upper - 1, lower - 1, -1):
+        piece = encoding.decode_single_token_bytes(tokens[index])
+        if b'\n\n' in piece:
+            return index + 1
+        if sentence_end is None and piece.rstrip().endswith(_SENTENCE_ENDINGS):
+            sentence_end = index + 1
+    return sentence_end or upper
+
+def split_text_into_chunks(text, max_tokens=3000, overlap=None, snap_to_breaks=None):
+    """Split text into chunks that won't exceed token limit.
+
+    Chunks are cut by slicing the token array. ``overlap`` tokens are repeated
+    at the start of the next chunk, and with ``snap_to_breaks`` each cut is
+    moved back to the nearest paragraph or sentence break in the last
+    CHUNK_SNAP_WINDOW of the chunk.
+    """
+    if overlap is None:
+        overlap = CHUNK_OVERLAP_TOKENS
+    if snap_to_breaks is None:
+        snap_to_breaks = CHUNK_SNAP_TO_BREAKS
+    overlap = max(0, min(overlap, max_tokens - 1))
+
+    started = time.perf_counter()
+    encoding = get_encoding()
     tokens = encoding.encode(text)
     chunks = []
-    current_chunk = []
-    current_length = 0
-    
-    for token in tokens:
-        if current_length >= max_tokens:
-            chunks.append(encoding.decode(current_chunk))
-            current_chunk = []
-            current_length = 0
-        current_chunk.append(token)
-        current_length += 1
-    
-    if current_chunk:
-        chunks.append(encoding.decode(current_chunk))
-    
+    start = 0
+
+    while start < len(tokens):
+        end = min(start + max_tokens, len(tokens))
+        if snap_to_breaks and end < len(tokens):
+            lower = max(end - int(max_tokens * CHUNK_SNAP_WINDOW), start + overlap + 1)
+            end = _find_chunk_break(encoding, tokens, lower, end)
+
+        chunks.append(encoding.decode(tokens[start:end]))
+        if end >= len(tokens):
+            break
+        start = end - overlap
+
+    metrics.CHUNKING_SECONDS.observe(time.perf_counter() - started)
+    metrics.CHUNKING_TOKENS.observe(len(tokens))
+    metrics.CHUNKS_PER_DOCUMENT.observe(len(chunks))
     return chunks
 
-def validate_and_fix_comps(analysis, time_range, session, api_key, base_url, org_id, headers):
+def recent_cutoff_year():
+    """Earliest publication year allowed for 'recent' comparable titles"""
+    return datetime.utcnow().year - RECENT_COMPS_YEARS
+
+def ground_comps(analysis):
+    """Correct or fill in the year of every comparable title found in the catalog"""
+    for comp in analysis.comps:
+        entry = comps_catalog.lookup(comp.title, comp.author)
+        if entry is not None:
+            comp.year = entry['year']
+    return analysis
+
+def replacement_candidates(analysis, stale, cutoff_year, limit=8):
+    """Recent catalog titles sharing the manuscript's genres, or the stale comps' genres and tropes"""
+    genres = [genre.lower() for genre in analysis.genres]
+    tropes = []
+    for comp in stale:
+        entry = comps_catalog.lookup(comp.title, comp.author)
+        if entry is not None:
+            genres.extend(entry['genres'])
+            tropes.extend(entry['tropes'])
+    if not genres and not tropes:
+        return []
+    return comps_catalog.candidates(genres, tropes, min_year=cutoff_year,
+                                    exclude=[comp.title for comp in analysis.comps], limit=limit)
+
+def stale_comps(analysis, cutoff_year):
+    """Comps with no year or a year before the cutoff"""
+    return [comp for comp in analysis.comps if comp.year is None or comp.year < cutoff_year]
+
+def comps_to_replace(analysis, time_range):
+    """Check 'recent' comps against the cutoff, using catalog years where known.
+
+    Returns the comps that are stale and need replacements from the LLM.
+    """
     if time_range != 'recent':
-        return analysis
-
-    current_year = 2025  # Since we know the current year from metadata
-    cutoff_year = current_year - 5
-
-    validation_prompt = f"""You are a literary agent validating comparable titles. The following analysis contains titles that may be older than {cutoff_year}.
-For each title, check its publication year. If any title was published before {cutoff_year}, provide a new comparable title published in {cutoff_year} or later that matches the same criteria.
-
-Current analysis:
-{analysis}
-
-For any title published before {cutoff_year}, provide a replacement in this format:
-REPLACE: [Old Title] ([Old Year])
-WITH: [New Title] by [Author] ([Year]) - [2-3 sentences explaining why this is a good replacement]
-
-If all titles are from {cutoff_year} or later, respond with: "All titles are within the 5-year range."
-
+        return []
+    if not analysis.comps:
+        # Unstructured reply; there are no comp records to check
+        metrics.COMP_VALIDATION.inc(outcome='unparsed')
+        return []
+
+    stale = stale_comps(analysis, recent_cutoff_year())
+    if not stale:
+        metrics.COMP_VALIDATION.inc(outcome='skipped')
+    return stale
+
+def replacement_messages(analysis, stale):
+    """Chat messages asking for replacements of the stale comps.
+
+    Recent catalog titles close to the manuscript are offered as verified
+    options; the model still picks the best fit and explains it.
+    """
+    cutoff_year = recent_cutoff_year()
+    candidates = replacement_candidates(analysis, stale, cutoff_year)
+    options = ''
+    if candidates:
+        options = f"""
+Verified titles published in {cutoff_year} or later; prefer these when one genuinely fits the manuscript:
+{chr(10).join(f"- {entry['title']} by {entry['author']} ({entry['year']}): {', '.join(entry['genres'] + entry['tropes'])}" for entry in candidates)}
+"""
+    manuscript = ''
+    if analysis.genres or analysis.audience:
+        manuscript = f"""
+The manuscript: {', '.join(analysis.genres) or 'genre unknown'}; {analysis.audience or 'audience unknown'}.
+"""
+    validation_prompt = f"""You are a literary agent validating comparable titles. Each title below was published before {cutoff_year} or has an unknown publication year.
+For each one that was published before {cutoff_year}, provide a new comparable title published in {cutoff_year} or later that matches the same criteria, with 2-3 sentences on how it resembles the manuscript.
+{manuscript}
+Titles to check:
+{chr(10).join(f"- {comp.heading()} [{comp.category}]: {comp.reason}" for comp in stale)}
+
+Titles already in the analysis (do not reuse):
+{chr(10).join(f"- {comp.title}" for comp in analysis.comps)}
+{options}
 Remember:
-1. Only suggest replacements for titles published before {cutoff_year}
+1. Only suggest replacements for titles published before {cutoff_year}; return no replacement for titles that are recent enough
 2. All replacement titles must be published in {cutoff_year} or later
 3. Maintain the same type of comparison (thematic, genre, voice, or trope) as the original
 4. Ensure the replacement title is not already used elsewhere in the analysis
 5. Include the publication year for each replacement title"""
 
-    data = {
-        'model': 'gpt-4',
-        'messages': [
-            {
-                'role': 'system',
-                'content': validation_prompt
-            },
-            {
-                'role': 'user',
-                'content': 'Please validate and provide replacements if needed.'
-            }
-        ],
-        'temperature': 0.7,
-        'max_tokens': 1000
-    }
-
-    try:
-        response = session.post(
-            f"{base_url}/v1/chat/completions",
-            headers=headers,
-            json=data,
-            timeout=60
-        )
-        
-        if response.status_code != 200:
-            return analysis
-
-        validation_result = response.json()['choices'][0]['message']['content']
-        
-        if "All titles are within the 5-year range" in validation_result:
-            return analysis
-
-        # Process replacements
-        replacements = []
-        for line in validation_result.split('\n'):
-            if line.startswith('REPLACE:'):
-                old_new = line.split('\nWITH:')
-                if len(old_new) == 2:
-                    old_title = old_new[0].replace('REPLACE:', '').strip()
-                    new_title_full = old_new[1].strip()
-                    replacements.append((old_title, new_title_full))
-
-        # Apply replacements
-        updated_analysis = analysis
-        for old_title, new_title_full in replacements:
-            # Extract just the title part from the old_title (before the year)
-            old_title_clean = old_title.split('(')[0].strip()
-            # Find and replace while preserving formatting
-            updated_analysis = updated_analysis.replace(old_title_clean, new_title_full)
-
-        return updated_analysis
-
-    except Exception as e:
-        print(f"Error in validation: {str(e)}")
+    return [
+        {
+            'role': 'system',
+            'content': validation_prompt
+        },
+        {
+            'role': 'user',
+            'content': 'Please validate and provide replacements if needed.'
+        }
+    ]
+
+def apply_replacements(analysis, stale, reply):
+    """Swap stale comps for the replacements in a record_replacements reply"""
+    replacements = parse_arguments(reply).get('replacements') or []
+    pending = list(stale)
+    replaced = 0
+    for replacement in replacements:
+        # old_title may come back with the author or year attached
+        old_title = normalize_title(str(replacement.get('old_title', '')))
+        comp = next((comp for comp in pending if old_title.startswith(normalize_title(comp.title))), None)
+        if comp is None:
+            continue
+        new = Comp.from_dict(dict(replacement, category=comp.category))
+        if not new.title:
+            continue
+        pending.remove(comp)
+        comp.title, comp.author, comp.year, comp.reason = new.title, new.author, new.year, new.reason
+        replaced += 1
+
+    if not replacements:
+        metrics.COMP_VALIDATION.inc(outcome='valid')
+    else:
+        metrics.COMP_VALIDATION.inc(outcome='replaced' if replaced else 'unparsed')
+    return ground_comps(analysis)
+
+def comp_validation_failed(analysis, error):
+    """Keep ``analysis`` as it was after the replacement request failed"""
+    logger.warning("Error in comp validation: %s", error)
+    metrics.COMP_VALIDATION.inc(outcome='error')
+    return analysis
+
+def validate_and_fix_comps(analysis, time_range):
+    stale = comps_to_replace(analysis, time_range)
+    if not stale:
         return analysis
 
-def analyze_chunk(chunk, time_range, session):
     try:
-        api_key = os.getenv('OPENAI_API_KEY')
-        base_url = os.getenv('OPENAI_BASE_URL')
-        org_id = os.getenv('OPENAI_ORG_ID')
-        
-        if not api_key or not base_url:
-            raise Exception("API configuration missing")
-
-        headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'User-Agent': 'ManuscriptAnalysis/1.0'
+        reply = get_client().chat(replacement_messages(analysis, stale), max_tokens=1000,
+                                  function=REPLACEMENTS_FUNCTION)
+        return apply_replacements(analysis, stale, reply)
+    except Exception as e:
+        return comp_validation_failed(analysis, e)
+
+def chunk_messages(chunk, time_range):
+    """Chat messages asking for a chunk's comparable titles"""
+    cutoff_year = recent_cutoff_year()
+    recent = f" published in {cutoff_year} or later" if time_range == 'recent' else ''
+
+    system_prompt = f"""You are a professional literary agent finding comparable titles for a manuscript.
+Record, with record_comparables, these comparable titles{recent}, each with its author, publication year and 2-3 sentences explaining the similarities:
+
+- primary: the three most similar overall matches, similar in multiple aspects
+- thematic: one title focusing specifically on thematic similarities, even if the genre, style, or target audience differs
+- genre: one title focusing specifically on genre similarities and conventions, even if themes or style differs
+- voice: one title focusing specifically on writing style and narrative voice similarities, even if genre or themes differ
+- trope: one title focusing specifically on similar story tropes and plot devices, even if execution differs
+
+Note: Each title should be unique. If the best match for a category is already listed, use the next best match.
+Exclude any titles that are part of the same series or by the same author as the submitted manuscript."""
+
+    return [
+        {
+            'role': 'system',
+            'content': system_prompt
+        },
+        {
+            'role': 'user',
+            'content': f"Analyze this manuscript chunk:\n\n{chunk}"
         }
-        
-        if org_id:
-            headers['X-Organization-ID'] = org_id
-
-        api_endpoint = f"{base_url}/v1/chat/completions"
-
-        system_prompt = f"""You are a professional literary agent compiling a final manuscript analysis. 
-Provide a concise analysis using EXACTLY this format with these EXACT headings:
-
-PRIMARY COMPARABLE TITLES:
-These are the three most similar overall matches to the manuscript{' published in the last 5 years (2020-2025)' if time_range == 'recent' else ''}:
-
-1. [Title 1 by Author] ([Publication Year]) - {' Must be 2020 or later' if time_range == 'recent' else ''}
-   - [2-3 sentences explaining overall similarities in multiple aspects]
-
-2. [Title 2 by Author] ([Publication Year]) - {' Must be 2020 or later' if time_range == 'recent' else ''}
-   - [2-3 sentences explaining overall similarities in multiple aspects]
+    ]
 
-3. [Title 3 by Author] ([Publication Year]) - {' Must be 2020 or later' if time_range == 'recent' else ''}
-   - [2-3 sentences explaining overall similarities in multiple aspects]
+def analyze_chunk(chunk, time_range):
+    import requests
 
-THEMATIC COMPARABLE:
-[Title by Author] ([Publication Year]) - {' Must be 2020 or later' if time_range == 'recent' else ''}
-- [2-3 sentences focusing specifically on thematic similarities, even if the genre, style, or target audience differs]
-
-GENRE COMPARABLE:
-[Title by Author] ([Publication Year]) - {' Must be 2020 or later' if time_range == 'recent' else ''}
-- [2-3 sentences focusing specifically on genre similarities and conventions, even if themes or style differs]
-
-VOICE COMPARABLE:
-[Title by Author] ([Publication Year]) - {' Must be 2020 or later' if time_range == 'recent' else ''}
-- [2-3 sentences focusing specifically on writing style and narrative voice similarities, even if genre or themes differ]
-
-TROPE COMPARABLE:
-[Title by Author] ([Publication Year]) - {' Must be 2020 or later' if time_range == 'recent' else ''}
-- [2-3 sentences focusing specifically on similar story tropes and plot devices, even if execution differs]
-
-Note: Each title should be unique. If the best match for a category is already listed, use the next best match. 
-Exclude any titles that are part of the same series or by the same author as the submitted manuscript.
-{' All comparable titles must have been published in 2020 or later.' if time_range == 'recent' else ''}"""
+    try:
+        client = get_client()
 
         # Initial analysis
-        for attempt in range(3):
-            try:
-                data = {
-                    'model': 'gpt-4',
-                    'messages': [
-                        {
-                            'role': 'system',
-                            'content': system_prompt
-                        },
-                        {
-                            'role': 'user',
-                            'content': f"Analyze this manuscript chunk:\n\n{chunk}"
-                        }
-                    ],
-                    'temperature': 0.7,
-                    'max_tokens': 1000
-                }
-
-                response = session.post(
-                    api_endpoint,
-                    headers=headers,
-                    json=data,
-                    timeout=60
-                )
-                
-                if response.status_code != 200:
-                    error_message = f"API Error: {response.status_code}"
-                    try:
-                        error_data = response.json()
-                        if 'error' in error_data:
-                            error_message += f" - {error_data['error'].get('message', '')}"
-                    except:
-                        error_message += f" - {response.text}"
-                    raise Exception(error_message)
-
-                analysis = response.json()['choices'][0]['message']['content']
-                
-                # Validate and fix publication years if needed
-                if time_range == 'recent':
-                    analysis = validate_and_fix_comps(analysis, time_range, session, api_key, base_url, org_id, headers)
-                
-                return analysis
-
-            except requests.exceptions.Timeout:
-                if attempt == 2:
-                    raise Exception("The analysis is taking longer than expected. Please try again with a shorter text.")
-                continue
-            except requests.exceptions.RequestException as e:
-                if attempt == 2:
-                    raise Exception(f"Error communicating with the analysis service: {str(e)}")
-                continue
+        try:
+            reply = client.chat(chunk_messages(chunk, time_range), max_tokens=1000,
+                                function=CHUNK_ANALYSIS_FUNCTION)
+        except requests.exceptions.Timeout:
+            raise Exception("The analysis is taking longer than expected. Please try again with a shorter text.")
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Error communicating with the analysis service: {str(e)}")
+
+        logger.debug("Analyzed chunk", extra={'chunk_chars': len(chunk), 'sample': True})
+        return ground_comps(Analysis.from_reply(reply))
 
     except Exception as e:
-        print(f"Error analyzing chunk: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error analyzing chunk")
         raise
 
-def compile_analysis(chunk_analyses):
-    """Compile all chunk analyses into a final comprehensive analysis"""
-    try:
-        api_key = os.getenv('OPENAI_API_KEY')
-        base_url = os.getenv('OPENAI_BASE_URL')
-        org_id = os.getenv('OPENAI_ORG_ID')
-        
-        if not api_key or not base_url:
-            raise Exception("API configuration missing")
-
-        headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'User-Agent': 'ManuscriptAnalysis/1.0'
+def format_analyses(analyses):
+    """Join analyses as numbered compact records for a compile prompt"""
+    return "\n".join(f"{number}: {analysis.dumps()}" for number, analysis in enumerate(analyses, 1))
+
+def group_analyses_by_tokens(analyses, budget):
+    """Greedily pack analyses into groups whose combined size fits the token budget.
+
+    Groups hold at least two analyses (only the last may hold one) so every
+    reduce round shrinks the list even when single analyses are large.
+    """
+    groups = []
+    current = []
+    current_tokens = 0
+    for analysis in analyses:
+        # A few extra tokens for the "n:" label and separator
+        tokens = count_tokens(analysis.dumps()) + 4
+        if len(current) >= 2 and current_tokens + tokens > budget:
+            groups.append(current)
+            current = []
+            current_tokens = 0
+        current.append(analysis)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+def reduce_rounds(chunk_analyses):
+    """Plan the compile tree-reduce one round at a time.
+
+    Each round yields the token-budgeted groups that need compiling and
+    expects the compiled analyses, one per group, to be sent back; a lone
+    leftover analysis is carried into the next round as-is. Returns the
+    analyses once they fit in a single compile prompt.
+    """
+    level = list(chunk_analyses)
+    while True:
+        groups = group_analyses_by_tokens(level, COMPILE_INPUT_TOKEN_BUDGET)
+        if len(groups) <= 1:
+            return level
+
+        logger.info("Reducing analyses", extra={'analyses': len(level), 'groups': len(groups)})
+        to_compile = [group for group in groups if len(group) > 1]
+        compiled = iter((yield to_compile))
+        level = [group[0] if len(group) == 1 else next(compiled) for group in groups]
+
+def reduce_analyses(chunk_analyses, compile_groups):
+    """Run reduce_rounds with ``compile_groups(groups)`` compiling each round, returning the final level"""
+    rounds = reduce_rounds(chunk_analyses)
+    compiled = None
+    while True:
+        try:
+            groups = rounds.send(compiled)
+        except StopIteration as done:
+            return done.value
+        compiled = compile_groups(groups)
+
+COMPILE_SYSTEM_PROMPT = f"""You are a professional literary agent compiling a final manuscript analysis from per-chunk analyses.
+{COMPACT_LEGEND}
+
+Record, with record_analysis, a concise analysis:
+
+- comps: the three primary comparable titles (most similar overall matches), then exactly one thematic, one genre, one voice and one trope comparable, each with its author, publication year and 2-3 sentences explaining the similarities for its category
+- score: the commercial score out of 10
+- strengths: three key strengths
+- weaknesses: three key weaknesses
+- genres: the main genre, then a secondary genre if applicable
+- audience: the core demographic description
+
+Note: Each title should be unique. If the best match for a category is already listed, use the next best match. Exclude any titles that are part of the same series or by the same author as the submitted manuscript."""
+
+def compile_messages(analyses):
+    """Chat messages asking for one analysis compiled from several"""
+    return [
+        {
+            'role': 'system',
+            'content': COMPILE_SYSTEM_PROMPT
+        },
+        {
+            'role': 'user',
+            'content': f"Based on these chunk analyses, provide a comprehensive manuscript analysis:\n\n{format_analyses(analyses)}"
         }
-        
-        if org_id:
-            headers['X-Organization-ID'] = org_id
-
-        session = requests.Session()
-        api_endpoint = f"{base_url}/v1/chat/completions"
-
-        system_prompt = """You are a professional literary agent compiling a final manuscript analysis. 
-Provide a concise analysis using EXACTLY this format with these EXACT headings:
-
-PRIMARY COMPARABLE TITLES:
-These are the three most similar overall matches to the manuscript:
-
-1. [Title 1 by Author]
-   - [2-3 sentences explaining overall similarities in multiple aspects]
-
-2. [Title 2 by Author]
-   - [2-3 sentences explaining overall similarities in multiple aspects]
-
-3. [Title 3 by Author]
-   - [2-3 sentences explaining overall similarities in multiple aspects]
-
-THEMATIC COMPARABLE:
-[Title by Author]
-- [2-3 sentences focusing specifically on thematic similarities, even if the genre, style, or target audience differs]
-
-GENRE COMPARABLE:
-[Title by Author]
-- [2-3 sentences focusing specifically on genre similarities and conventions, even if themes or style differs]
-
-VOICE COMPARABLE:
-[Title by Author]
-- [2-3 sentences focusing specifically on writing style and narrative voice similarities, even if genre or themes differ]
-
-TROPE COMPARABLE:
-[Title by Author]
-- [2-3 sentences focusing specifically on similar story tropes and plot devices, even if execution differs]
-
-Note: Each title should be unique. If the best match for a category is already listed, use the next best match. Exclude any titles that are part of the same series or by the same author as the submitted manuscript.
-
-COMMERCIAL SCORE: [Score]/10
-
-STRENGTHS:
-- [Key strength 1]
-- [Key strength 2]
-- [Key strength 3]
-
-WEAKNESSES:
-- [Key weakness 1]
-- [Key weakness 2]
-- [Key weakness 3]
-
-GENRES:
-- Primary: [Main genre]
-- Secondary: [Secondary genre if applicable]
-
-TARGET AUDIENCE:
-- [Core demographic description]"""
+    ]
+
+def compile_analysis(chunk_analyses, on_token=None):
+    """Compile all chunk analyses into a final comprehensive analysis.
+
+    Chunk analyses go into the prompt as compact records and the result comes
+    back as an Analysis through function calling. When the analyses are
+    larger than COMPILE_INPUT_TOKEN_BUDGET they are tree-reduced:
+    token-budgeted groups are compiled in parallel, and the results are
+    compiled again until they fit in a single prompt. If ``on_token`` is
+    given the final compile is streamed and each fragment of the function
+    arguments is passed to it as it arrives.
+    """
+    try:
+        client = get_client()
 
-        data = {
-            'model': 'gpt-4',
-            'messages': [
-                {
-                    'role': 'system',
-                    'content': system_prompt
-                },
-                {
-                    'role': 'user',
-                    'content': f"Based on these chunk analyses, provide a comprehensive manuscript analysis:\n\n{json.dumps(chunk_analyses, indent=2)}"
-                }
-            ],
-            'temperature': 0.7,
-            'max_tokens': 1500
-        }
+        def compile_group(analyses, on_token=None):
+            reply = client.chat(compile_messages(analyses), max_tokens=1500, on_token=on_token,
+                                function=ANALYSIS_FUNCTION)
+            return Analysis.from_reply(reply)
 
-        response = session.post(
-            api_endpoint,
-            headers=headers,
-            json=data,
-            timeout=30
-        )
-        
-        if response.status_code != 200:
-            raise Exception(f"API Error: {response.status_code} - {response.text}")
+        def compile_groups(groups):
+            with ThreadPoolExecutor(max_workers=max(1, min(ANALYSIS_CONCURRENCY, len(groups)))) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, compile_group, group)
+                           for group in groups]
+                return [future.result() for future in futures]
 
-        response_data = response.json()
-        return response_data['choices'][0]['message']['content']
+        return compile_group(reduce_analyses(chunk_analyses, compile_groups), on_token=on_token)
 
     except Exception as e:
-        print(f"Error compiling analysis: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error compiling analysis")
         raise
 
 @app.route('/analyze', methods=['POST'])
@@ -466,9 +1013,19 @@ def analyze():
         if not text:
             return jsonify({'error': 'No text provided'}), 400
 
-        analysis = analyze_text(text, time_range)
-        return jsonify({'result': analysis})
+        check_text_admission(text)
+        if wants_job(data):
+            return submit_job('text', time_range, text=text)
+
+        acquire_analysis_slot()
+        try:
+            analysis, result_id = analyze_and_store(text, time_range)
+        finally:
+            release_analysis_slot()
+        return jsonify({'result': analysis, 'resultId': result_id})
 
+    except AdmissionRejected as e:
+        return e.response()
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -487,79 +1044,822 @@ def upload_file():
         if not file.filename.endswith('.pdf'):
             return jsonify({'error': 'File must be a PDF'}), 400
 
-        # Read the PDF file
-        pdf_text = process_pdf(file)
-        
-        if not pdf_text.strip():
-            return jsonify({'error': 'Could not extract text from PDF'}), 400
+        if wants_job():
+            # The upload stream closes with the request, so hand the worker a copy
+            pdf_file = spool_upload(file, copy=True)
+            try:
+                check_pdf_admission(pdf_file)
+            except AdmissionRejected:
+                pdf_file.close()
+                raise
+            return submit_job('pdf', time_range, pdf_file=pdf_file)
+
+        # Page and token limits are checked before the slot is taken or the full extraction runs
+        check_pdf_admission(spool_upload(file))
+        acquire_analysis_slot()
+        try:
+            # Read the PDF file
+            pdf_details = {}
+            pdf_text = process_pdf(file, pdf_details)
+
+            if not pdf_text.strip():
+                return jsonify({'error': 'Could not extract text from PDF'}), 400
+
+            # The sampled estimate can be off, so the extracted text is checked too
+            check_text_admission(pdf_text)
+            # Analyze the extracted text
+            analysis, result_id = analyze_and_store(pdf_text, time_range, details=pdf_details)
+        finally:
+            release_analysis_slot()
+        return jsonify({'result': analysis, 'resultId': result_id})
+
+    except AdmissionRejected as e:
+        return e.response()
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        # Analyze the extracted text
-        analysis = analyze_text(pdf_text, time_range)
-        return jsonify({'result': analysis})
+def analysis_cache_key(level, text, time_range):
+    """The analysis cache key for ``text`` at ``level`` ('analysis' or 'chunk'), or None with the cache disabled"""
+    if not ANALYSIS_CACHE_ENABLED:
+        return None
+    return make_cache_key(level, text, time_range, PROMPT_VERSION)
+
+def analyze_chunk_cached(chunk, time_range):
+    """analyze_chunk behind the per-chunk level of the analysis cache"""
+    key = analysis_cache_key('chunk', chunk, time_range)
+    cached = analysis_cache.get(key) if key else None
+    if cached is not None:
+        return Analysis.loads(cached)
+    analysis = analyze_chunk(chunk, time_range)
+    if key:
+        analysis_cache.set(key, analysis.dumps())
+    return analysis
+
+def analyze_chunks(chunks, time_range, max_workers=None, on_chunk_done=None):
+    """Analyze chunks concurrently, returning the analyses in chunk order.
+
+    At most ``max_workers`` (default ANALYSIS_CONCURRENCY) chunks are in flight
+    at once. The first chunk that fails cancels every chunk not yet started and
+    its exception is re-raised. ``on_chunk_done(index)`` is called as each
+    chunk finishes.
+    """
+    if max_workers is None:
+        max_workers = ANALYSIS_CONCURRENCY
+    max_workers = max(1, min(max_workers, len(chunks)))
+
+    if max_workers == 1:
+        analyses = []
+        for index, chunk in enumerate(chunks):
+            analyses.append(analyze_chunk_cached(chunk, time_range))
+            if on_chunk_done:
+                on_chunk_done(index)
+        return analyses
+
+    analyses = [None] * len(chunks)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {
+            executor.submit(contextvars.copy_context().run, analyze_chunk_cached, chunk, time_range): index
+            for index, chunk in enumerate(chunks)
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            analyses[index] = future.result()
+            if on_chunk_done:
+                on_chunk_done(index)
+    finally:
+        # Drop queued chunks on failure; running ones finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return analyses
+
+def analyze_text(text, time_range='all', progress=None, stream_compile=False):
+    """Run the full pipeline over text and return the analysis rendered as text"""
+    return analyze_text_structured(text, time_range, progress, stream_compile).render()
+
+def chunk_stage_error(error, timeout_errors, request_errors):
+    """The user-facing exception for a failure while analyzing chunks"""
+    if isinstance(error, timeout_errors):
+        return Exception("The analysis is taking longer than expected. Please try again with a shorter text or try again later.")
+    if isinstance(error, request_errors):
+        return Exception(f"Error communicating with the analysis service: {str(error)}")
+    return Exception(f"An unexpected error occurred: {str(error)}")
+
+class AnalysisRun:
+    """Cache and ``details`` bookkeeping for one run of the analysis pipeline.
+
+    Shared by analyze_text_structured and its async counterpart so both
+    record the same 'cached', 'chunks' and 'timings' details.
+    """
+
+    def __init__(self, text, time_range, details):
+        self.details = details
+        self.started = self.stage_started = time.perf_counter()
+        self.cache_key = analysis_cache_key('analysis', text, time_range)
+        details['cached'] = False
+
+    def cache_hit(self, cached):
+        """The Analysis for a value read from the cache under cache_key, or None on a miss"""
+        if cached is None:
+            return None
+        logger.info("Analysis cache hit", extra={'sample': True})
+        self.details['cached'] = True
+        return Analysis.loads(cached)
+
+    def stage_done(self, stage):
+        """Record the time since the previous stage finished as ``stage``"""
+        now = time.perf_counter()
+        self.details.setdefault('timings', {})[stage] = now - self.stage_started
+        self.stage_started = now
+
+    def chunks_done(self, analyses):
+        self.details['chunks'] = analyses
+        self.stage_done('chunks')
+
+    def finish(self, analysis):
+        """Record the total time and return the value to cache under cache_key, or None"""
+        self.details['timings']['total'] = time.perf_counter() - self.started
+        logger.info("Analysis complete", extra={'chunks': len(self.details['chunks']), 'sample': True})
+        return analysis.dumps() if self.cache_key else None
+
+def analyze_text_structured(text, time_range='all', progress=None, stream_compile=False, details=None):
+    """Run the full chunk-analyze-compile pipeline over text, returning an Analysis.
+
+    ``progress``, if given, is called as ``progress(stage, info)`` with stages
+    'chunked' ({'total', 'duplicates', 'tokens_saved'}), 'chunk' ({'index', 'total'}) and 'compiling' ({}).
+    With ``stream_compile`` it also gets a 'token' stage ({'text'}) with each
+    section of the final compile, rendered as soon as it has streamed in.
+    Results are cached, as compact records, on the normalized text, time
+    range and PROMPT_VERSION. A ``details`` dict is filled with 'cached',
+    and for fresh runs 'chunks' (the chunk analyses), 'stats' and 'timings'.
+    """
+    import requests
+
+    details = {} if details is None else details
+    run = AnalysisRun(text, time_range, details)
+    if run.cache_key:
+        cached = run.cache_hit(analysis_cache.get(run.cache_key))
+        if cached is not None:
+            return cached
+
+    chunks = prepare_chunks(text, time_range, details, progress)
+    run.stage_done('preparing')
+
+    def on_chunk_done(index):
+        if progress:
+            progress('chunk', {'index': index, 'total': len(chunks)})
 
+    try:
+        all_analyses = analyze_chunks(chunks, time_range, on_chunk_done=on_chunk_done)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        raise chunk_stage_error(e, requests.exceptions.Timeout, requests.exceptions.RequestException)
+    run.chunks_done(all_analyses)
+
+    on_token = None
+    if progress and stream_compile:
+        members = JSONMemberStream()
+
+        def emit_sections(completed):
+            for key, value in completed:
+                section = Analysis.from_dict({key: value}).render()
+                if section:
+                    progress('token', {'text': section + '\n\n'})
+
+        def on_token(fragment):
+            emit_sections(members.feed(fragment))
+
+    if progress:
+        progress('compiling', {})
+    with metrics.COMPILE_SECONDS.time():
+        final_analysis = compile_analysis(all_analyses, on_token=on_token)
+    if on_token:
+        emit_sections(members.close())
+    run.stage_done('compile')
+    # Checked once on the compiled result rather than on every chunk
+    final_analysis = validate_and_fix_comps(ground_comps(final_analysis), time_range)
+    run.stage_done('validation')
+    cached = run.finish(final_analysis)
+    if cached:
+        analysis_cache.set(run.cache_key, cached)
+    return final_analysis
 
-def analyze_text(text, time_range='all'):
+def prepare_chunks(text, time_range, details, progress=None):
+    """Clean up and chunk text for analysis, dropping near-duplicate chunks.
+
+    Records the chunk and dedup counts in ``details['stats']`` and reports
+    them to ``progress`` as the 'chunked' stage. Savings already recorded
+    in ``details['tokens_saved']`` by process_pdf are included.
+    """
+    duplicates = {}
+    tokens_saved = details.get('tokens_saved', 0)
+    if DEDUP_ENABLED:
+        text, repeated = drop_repeated_paragraphs(normalize_manuscript(text))
+        if repeated:
+            saved = count_tokens('\n\n'.join(repeated))
+            metrics.DEDUP_TOKENS_SAVED.inc(saved, stage='repeated_paragraphs')
+            tokens_saved += saved
     chunks = split_text_into_chunks(text)
-    all_analyses = []
-
-    session = requests.Session()
-    adapter = requests.adapters.HTTPAdapter(
-        max_retries=requests.urllib3.Retry(
-            total=3,
-            backoff_factor=1,
-            status_forcelist=[500, 502, 503, 504]
-        )
-    )
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-
-    for chunk in chunks:
+    if DEDUP_ENABLED:
+        duplicates = find_duplicate_chunks(chunks, DEDUP_THRESHOLD)
+        if duplicates:
+            saved = sum(count_tokens(chunks[index]) for index in duplicates)
+            metrics.DEDUP_TOKENS_SAVED.inc(saved, stage='duplicate_chunks')
+            tokens_saved += saved
+            chunks = [chunk for index, chunk in enumerate(chunks) if index not in duplicates]
+    logger.info("Analyzing text", extra={'chars': len(text), 'chunks': len(chunks), 'time_range': time_range,
+                                         'duplicate_chunks': len(duplicates), 'tokens_saved': tokens_saved})
+    if progress:
+        progress('chunked', {'total': len(chunks), 'duplicates': len(duplicates), 'tokens_saved': tokens_saved})
+    details['stats'] = {'chunks': len(chunks), 'duplicate_chunks': len(duplicates), 'tokens_saved': tokens_saved}
+    return chunks
+
+def new_result_id():
+    """A random id for /results/<id>; ObjectIds are time-ordered, so they could be enumerated"""
+    return secrets.token_urlsafe(16)
+
+def analysis_document(text_hash, time_range, analysis, details):
+    """The db.analyses document for an analysis and its pipeline details"""
+    return {
+        '_id': new_result_id(),
+        'text_hash': text_hash,
+        'time_range': time_range,
+        'prompt_version': PROMPT_VERSION,
+        'result': analysis.render(),
+        'analysis': analysis.to_compact(),
+        'chunks': [chunk.to_compact() for chunk in details.get('chunks', [])],
+        'timings': {stage: round(seconds, 3) for stage, seconds in details.get('timings', {}).items()},
+        'stats': details.get('stats', {}),
+        'created_at': datetime.utcnow()
+    }
+
+def existing_analysis_query(text_hash, time_range):
+    """find_one arguments for the newest stored analysis of the same text, by its id only"""
+    return {
+        'filter': {'text_hash': text_hash, 'time_range': time_range, 'prompt_version': PROMPT_VERSION,
+                   '_id': {'$type': 'string'}},
+        'projection': {'_id': 1},
+        'sort': [('created_at', -1)]
+    }
+
+def store_analysis(text, time_range, analysis, details):
+    """Save an analysis to db.analyses and return its id, or None if MongoDB is unavailable.
+
+    A cached analysis reuses the stored document for the same text when one
+    has not expired yet; fresh runs also keep the chunk analyses and timings.
+    """
+    try:
+        db = get_db()
+        text_hash = hash_text(text)
+        if details.get('cached'):
+            existing = db.analyses.find_one(**existing_analysis_query(text_hash, time_range))
+            if existing is not None:
+                return str(existing['_id'])
+
+        document = analysis_document(text_hash, time_range, analysis, details)
+        return str(db.analyses.insert_one(document).inserted_id)
+    except Exception as e:
+        logger.error("Error storing analysis: %s", e)
+        return None
+
+def analyze_and_store(text, time_range='all', progress=None, stream_compile=False, details=None):
+    """analyze_text that also persists the result, returning (rendered text, result id)"""
+    details = {} if details is None else details
+    analysis = analyze_text_structured(text, time_range, progress, stream_compile, details=details)
+    return analysis.render(), store_analysis(text, time_range, analysis, details)
+
+_job_executor = None
+_job_executor_lock = threading.Lock()
+# Each queued job can hold a spooled upload, so the executor's queue is bounded here
+_job_slots = threading.BoundedSemaphore(max(MAX_QUEUED_JOBS, 1))
+
+def get_job_executor():
+    """Get the process-wide executor for analysis jobs, creating it if necessary"""
+    global _job_executor
+    with _job_executor_lock:
+        if _job_executor is None:
+            _job_executor = ThreadPoolExecutor(max_workers=max(JOB_WORKERS, 1),
+                                               thread_name_prefix='analysis-job')
+        return _job_executor
+
+def create_job(kind, time_range):
+    """Insert a queued job document and return its id"""
+    db = get_db()
+    job_id = uuid.uuid4().hex
+    now = datetime.utcnow()
+    db.jobs.insert_one({
+        '_id': job_id,
+        'kind': kind,
+        'time_range': time_range,
+        'status': 'queued',
+        'stage': 'queued',
+        'total_chunks': None,
+        'completed_chunks': 0,
+        'duplicate_chunks': None,
+        'tokens_saved': None,
+        'chunks': [],
+        'result': None,
+        'result_id': None,
+        'error': None,
+        'created_at': now,
+        'updated_at': now
+    })
+    return job_id
+
+def fail_if_stale(db, job):
+    """Mark a queued or running job failed once it has gone JOB_STALE_SECONDS without an update.
+
+    Its worker most likely died with the process, so nothing will ever
+    finish it. Returns the job as it now stands.
+    """
+    if job['status'] not in ('queued', 'running'):
+        return job
+    now = datetime.utcnow()
+    if (now - job['updated_at']).total_seconds() < JOB_STALE_SECONDS:
+        return job
+
+    fields = {'status': 'failed', 'error': 'The job stopped making progress, please submit it again',
+              'updated_at': now}
+    # Only if nothing has updated the job since it was read
+    updated = db.jobs.update_one({'_id': job['_id'], 'status': job['status'], 'updated_at': job['updated_at']},
+                                 {'$set': fields})
+    if updated.modified_count:
+        logger.warning("Marked stale job failed", extra={'job_id': job['_id'], 'stage': job.get('stage')})
+        return dict(job, **fields)
+    return db.jobs.find_one({'_id': job['_id']}) or job
+
+def run_analysis_job(job_id, time_range, text=None, pdf_file=None):
+    """Run the analysis pipeline for a job, recording progress in db.jobs"""
+    try:
+        db = get_db()
+    except Exception as e:
+        logger.error("Job could not reach MongoDB: %s", e, extra={'job_id': job_id})
+        return
+
+    def update(fields, inc=None):
+        change = {'$set': dict(fields, updated_at=datetime.utcnow())}
+        if inc:
+            change['$inc'] = inc
+        db.jobs.update_one({'_id': job_id}, change)
+
+    def progress(stage, info):
+        if stage == 'chunked':
+            update({'stage': 'analyzing',
+                    'total_chunks': info['total'],
+                    'duplicate_chunks': info['duplicates'],
+                    'tokens_saved': info['tokens_saved'],
+                    'chunks': ['pending'] * info['total']})
+        elif stage == 'chunk':
+            update({f"chunks.{info['index']}": 'done'}, inc={'completed_chunks': 1})
+        elif stage == 'compiling':
+            update({'stage': 'compiling'})
+
+    try:
+        update({'status': 'running', 'stage': 'extracting' if pdf_file else 'chunking'})
+        details = {}
+        if pdf_file is not None:
+            text = process_pdf(pdf_file, details)
+            if not text.strip():
+                raise Exception('Could not extract text from PDF')
+            check_text_admission(text)
+
+        result, result_id = analyze_and_store(text, time_range, progress=progress, details=details)
+        update({'status': 'completed', 'stage': 'done', 'result': result, 'result_id': result_id})
+    except Exception as e:
+        logger.exception("Job failed", extra={'job_id': job_id})
+        update({'status': 'failed', 'error': str(e)})
+    finally:
+        if pdf_file is not None:
+            pdf_file.close()
+
+def submit_job(kind, time_range, text=None, pdf_file=None):
+    """Create a job and hand it to the background workers, returning the 202 response.
+
+    Raises a 429 AdmissionRejected when MAX_QUEUED_JOBS jobs are already
+    queued or running.
+    """
+    if not _job_slots.acquire(blocking=False):
+        if pdf_file is not None:
+            pdf_file.close()
+        metrics.ADMISSION_REJECTED.inc(reason='jobs')
+        raise AdmissionRejected('Too many analysis jobs queued, please retry shortly', 429,
+                                retry_after=ADMISSION_RETRY_AFTER_SECONDS)
+    try:
+        job_id = create_job(kind, time_range)
+        future = get_job_executor().submit(contextvars.copy_context().run, run_analysis_job, job_id,
+                                           time_range, text=text, pdf_file=pdf_file)
+    except Exception:
+        _job_slots.release()
+        if pdf_file is not None:
+            pdf_file.close()
+        raise
+    future.add_done_callback(lambda future: _job_slots.release())
+    return jsonify({
+        'jobId': job_id,
+        'status': 'queued',
+        'statusUrl': f'/jobs/{job_id}'
+    }), 202
+
+def wants_job(data=None):
+    """Whether the client asked for job mode via ?mode=job or a mode field"""
+    mode = request.values.get('mode')
+    if mode is None and data:
+        mode = data.get('mode')
+    return mode == 'job'
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    try:
+        db = get_db()
+        job = db.jobs.find_one({'_id': job_id})
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        job = fail_if_stale(db, job)
+
+        return jsonify({
+            'jobId': job['_id'],
+            'status': job['status'],
+            'stage': job.get('stage'),
+            'totalChunks': job.get('total_chunks'),
+            'duplicateChunks': job.get('duplicate_chunks'),
+            'tokensSaved': job.get('tokens_saved'),
+            'completedChunks': job.get('completed_chunks', 0),
+            'chunks': job.get('chunks', []),
+            'result': job.get('result'),
+            'resultId': job.get('result_id'),
+            'error': job.get('error'),
+            'createdAt': job['created_at'].isoformat(),
+            'updatedAt': job['updated_at'].isoformat()
+        })
+    except Exception as e:
+        error_msg = f"Error getting job: {str(e)}"
+        logger.exception("Error getting job")
+        return jsonify({'error': error_msg}), 500
+
+# Result ids are new_result_id() tokens; older ObjectId-keyed analyses are not served
+_result_id_re = re.compile(r'[A-Za-z0-9_-]{22}')
+
+# Fields /results/<id> can return; chunk analyses are large, so only on request
+RESULT_FIELDS = ('result', 'analysis', 'chunks', 'timings', 'stats', 'time_range', 'created_at')
+DEFAULT_RESULT_FIELDS = ('result', 'analysis', 'timings', 'stats', 'time_range', 'created_at')
+
+@app.route('/results/<result_id>', methods=['GET'])
+def get_result(result_id):
+    """A stored analysis; ?fields=a,b limits the response to those fields"""
+    try:
+        if not _result_id_re.fullmatch(result_id):
+            return jsonify({'error': 'Invalid result id'}), 400
+
+        fields = DEFAULT_RESULT_FIELDS
+        requested = request.args.get('fields')
+        if requested:
+            fields = [field.strip() for field in requested.split(',') if field.strip()]
+            unknown = [field for field in fields if field not in RESULT_FIELDS]
+            if unknown or not fields:
+                return jsonify({'error': f"Unknown fields: {', '.join(unknown)}",
+                                'allowed': list(RESULT_FIELDS)}), 400
+
+        db = get_db()
+        # Projected server-side so unrequested fields never leave MongoDB
+        document = db.analyses.find_one({'_id': result_id}, projection={field: 1 for field in fields})
+        if document is None:
+            return jsonify({'error': 'Result not found'}), 404
+
+        response = {'resultId': str(document.pop('_id'))}
+        if 'time_range' in document:
+            response['timeRange'] = document.pop('time_range')
+        if 'created_at' in document:
+            response['createdAt'] = document.pop('created_at').isoformat()
+        response.update(document)
+        return jsonify(response)
+    except Exception as e:
+        error_msg = f"Error getting result: {str(e)}"
+        logger.exception("Error getting result")
+        return jsonify({'error': error_msg}), 500
+
+# Seconds between SSE keep-alive comments while waiting on the pipeline
+STREAM_HEARTBEAT_SECONDS = 15
+
+def sse_event(event, data):
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+class AnalysisCancelled(Exception):
+    """Raised from a progress callback to abandon an analysis nobody is waiting for"""
+
+def stream_analysis(time_range, text=None, pdf_file=None):
+    """Run the pipeline in a background thread and stream its progress as SSE.
+
+    Events: 'extracting', 'chunked', 'chunk' ({'completed', 'total'}, in
+    completion order), 'compiling', 'token' (pieces of the final compile),
+    then 'result' or 'error'. Admission is checked before the stream starts,
+    so rejections are still plain 413/429 responses. If the client
+    disconnects, the analysis stops at its next progress report, and chunks
+    not yet started are cancelled.
+    """
+    try:
+        if pdf_file is not None:
+            check_pdf_admission(pdf_file)
+        else:
+            check_text_admission(text)
+        acquire_analysis_slot()
+    except AdmissionRejected:
+        if pdf_file is not None:
+            pdf_file.close()
+        raise
+
+    events = queue.Queue()
+    cancelled = threading.Event()
+    completed_chunks = 0
+
+    def progress(stage, info):
+        nonlocal completed_chunks
+        if cancelled.is_set():
+            raise AnalysisCancelled()
+        if stage == 'chunk':
+            # Chunks finish out of order, so clients get a count rather than an index
+            completed_chunks += 1
+            info = {'completed': completed_chunks, 'total': info['total']}
+        events.put((stage, info))
+
+    def run():
         try:
-            analysis = analyze_chunk(chunk, time_range, session)
-            all_analyses.append(analysis)
-        except requests.exceptions.Timeout:
-            raise Exception("The analysis is taking longer than expected. Please try again with a shorter text or try again later.")
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"Error communicating with the analysis service: {str(e)}")
+            body = text
+            details = {}
+            if pdf_file is not None:
+                events.put(('extracting', {}))
+                body = process_pdf(pdf_file, details)
+                if not body.strip():
+                    raise Exception('Could not extract text from PDF')
+                check_text_admission(body)
+            result, result_id = analyze_and_store(body, time_range, progress=progress, stream_compile=True,
+                                                  details=details)
+            events.put(('result', {'result': result, 'resultId': result_id}))
         except Exception as e:
-            raise Exception(f"An unexpected error occurred: {str(e)}")
+            if cancelled.is_set():
+                logger.info("Stream client disconnected, analysis cancelled")
+            else:
+                events.put(('error', {'error': str(e)}))
+        finally:
+            release_analysis_slot()
+            if pdf_file is not None:
+                pdf_file.close()
+            events.put(None)
+
+    threading.Thread(target=contextvars.copy_context().run, args=(run,),
+                     name='analysis-stream', daemon=True).start()
+
+    def generate():
+        try:
+            while True:
+                try:
+                    item = events.get(timeout=STREAM_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    # Keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                if item is None:
+                    break
+                yield sse_event(*item)
+        finally:
+            # Also reached through GeneratorExit when the client disconnects
+            cancelled.set()
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/analyze/stream', methods=['POST'])
+def analyze_stream():
+    data = request.get_json()
+    text = data.get('text', '') if data else ''
+    time_range = data.get('timeRange', 'all') if data else 'all'
+
+    if not text:
+        return jsonify({'error': 'No text provided'}), 400
+
+    return stream_analysis(time_range, text=text)
+
+@app.route('/upload/stream', methods=['POST'])
+def upload_stream():
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file provided'}), 400
+
+    file = request.files['file']
+    time_range = request.form.get('timeRange', 'all')
+
+    if file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+
+    if not file.filename.endswith('.pdf'):
+        return jsonify({'error': 'File must be a PDF'}), 400
+
+    # The upload stream closes with the request, so hand the worker a copy
+    return stream_analysis(time_range, pdf_file=spool_upload(file, copy=True))
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    secret_key = request.args.get('key')
+    if not secret_key or secret_key != os.getenv('ADMIN_KEY'):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    return jsonify({
+        'enabled': ANALYSIS_CACHE_ENABLED,
+        'promptVersion': PROMPT_VERSION,
+        'stats': analysis_cache.stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/llm/stats', methods=['GET'])
+def llm_stats():
+    secret_key = request.args.get('key')
+    if not secret_key or secret_key != os.getenv('ADMIN_KEY'):
+        return jsonify({'error': 'Unauthorized'}), 401
 
-    final_analysis = compile_analysis(all_analyses)
-    return final_analysis
+    try:
+        client = get_client()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    return jsonify({
+        'stats': client.stats.snapshot(),
+        'concurrencyLimit': int(client.concurrency.limit),
+        'inFlight': client.concurrency.in_flight
+    })
+
+def encode_subscriber_cursor(subscriber):
+    """Opaque pagination cursor pointing just past a subscriber"""
+    raw = json.dumps([subscriber['timestamp'].isoformat(), str(subscriber['_id'])])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_subscriber_cursor(cursor):
+    """Turn a pagination cursor back into a query for the subscribers after it"""
+    timestamp, object_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    timestamp = datetime.fromisoformat(timestamp)
+    object_id = ObjectId(object_id)
+    return {'$or': [
+        {'timestamp': {'$gt': timestamp}},
+        {'timestamp': timestamp, '_id': {'$gt': object_id}}
+    ]}
 
 @app.route('/subscribers', methods=['GET'])
 def get_subscribers():
+    """A page of active subscribers in signup order.
+
+    ``count`` is the number on this page; the total number of active
+    subscribers costs a full count, so it is only included as ``total`` with
+    ?withTotal=1.
+    """
     try:
         # Check if the request includes a secret key
         secret_key = request.args.get('key')
         if not secret_key or secret_key != os.getenv('ADMIN_KEY'):
             return jsonify({'error': 'Unauthorized'}), 401
 
-        # Get fresh DB connection
+        try:
+            limit = int(request.args.get('limit', SUBSCRIBERS_PAGE_SIZE))
+            query = {'status': 'active'}
+            if request.args.get('cursor'):
+                query.update(decode_subscriber_cursor(request.args['cursor']))
+        except (ValueError, TypeError, InvalidId):
+            return jsonify({'error': 'Invalid limit or cursor'}), 400
+        limit = max(1, min(limit, SUBSCRIBERS_MAX_PAGE_SIZE))
+
         db = get_db()
         if db is None:
             return jsonify({'error': 'Database not connected'}), 500
 
-        subscribers = list(db.subscribers.find(
-            {'status': 'active'}, 
-            {'_id': 0, 'email': 1, 'timestamp': 1}
-        ))
-        
-        # Convert to JSON-serializable format
-        subscribers = json.loads(json_util.dumps(subscribers))
-        
+        page = list(db.subscribers.find(query, {'email': 1, 'timestamp': 1})
+                    .sort([('timestamp', ASCENDING), ('_id', ASCENDING)])
+                    .limit(limit))
+
+        response = {
+            'count': len(page),
+            'subscribers': [
+                {'email': sub['email'], 'timestamp': sub['timestamp'].isoformat()}
+                for sub in page
+            ],
+            'nextCursor': encode_subscriber_cursor(page[-1]) if len(page) == limit else None
+        }
+        if request.args.get('withTotal') in ('1', 'true'):
+            response['total'] = db.subscribers.count_documents({'status': 'active'})
+        return jsonify(response)
+    except Exception as e:
+        error_msg = f"Error getting subscribers: {str(e)}\nType: {type(e)}"
+        logger.exception("Error getting subscribers")
+        return jsonify({'error': error_msg}), 500
+
+def parse_subscriber_lines(lines):
+    """Parse lines in the user_emails.txt format ("email,signup_date", # comments).
+
+    Returns (entries, invalid) where entries are (email, timestamp) pairs.
+    Missing or unparseable signup dates default to now.
+    """
+    entries = []
+    invalid = 0
+    now = datetime.utcnow()
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        email, _, signup_date = line.partition(',')
+        email = email.strip()
+        if not is_valid_email(email):
+            invalid += 1
+            continue
+        try:
+            timestamp = datetime.fromisoformat(signup_date.strip()) if signup_date.strip() else now
+        except ValueError:
+            timestamp = now
+        entries.append((email, timestamp))
+    return entries, invalid
+
+def bulk_import_subscribers(db, entries, batch_size=SUBSCRIBER_IMPORT_BATCH_SIZE, reactivate=False):
+    """Upsert subscribers in unordered bulk_write batches.
+
+    Existing subscribers keep their status unless ``reactivate`` is set.
+    Returns (inserted, duplicates): duplicates covers addresses repeated in
+    the input as well as ones already subscribed.
+    """
+    inserted = 0
+    duplicates = 0
+    seen = set()
+    batch = []
+
+    def flush():
+        nonlocal inserted, duplicates
+        try:
+            result = db.subscribers.bulk_write(batch, ordered=False)
+            batch_inserted = result.upserted_count
+        except BulkWriteError as e:
+            # Duplicate key races with concurrent signups; everything else is fatal
+            if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+            batch_inserted = e.details.get('nUpserted', 0)
+        inserted += batch_inserted
+        duplicates += len(batch) - batch_inserted
+
+    for email, timestamp in entries:
+        normalized = normalize_email(email)
+        if normalized in seen:
+            duplicates += 1
+            continue
+        seen.add(normalized)
+        batch.append(UpdateOne(*subscriber_upsert(email, timestamp, reactivate), upsert=True))
+        if len(batch) >= batch_size:
+            flush()
+            batch = []
+    if batch:
+        flush()
+
+    return inserted, duplicates
+
+@app.route('/subscribers/import', methods=['POST'])
+def import_subscribers():
+    try:
+        secret_key = request.args.get('key')
+        if not secret_key or secret_key != os.getenv('ADMIN_KEY'):
+            return jsonify({'error': 'Unauthorized'}), 401
+
+        # Accept {"emails": [...]}, an uploaded file, or a raw user_emails.txt body
+        data = request.get_json(silent=True)
+        if data and isinstance(data.get('emails'), list):
+            lines = [str(email) for email in data['emails']]
+        else:
+            raw = request.files['file'].read() if 'file' in request.files else request.get_data()
+            encoding = 'utf-16' if raw[:2] in (b'\xff\xfe', b'\xfe\xff') else 'utf-8-sig'
+            lines = raw.decode(encoding).splitlines()
+
+        entries, invalid = parse_subscriber_lines(lines)
+
+        db = get_db()
+        if db is None:
+            return jsonify({'error': 'Database not connected'}), 500
+
+        inserted, duplicates = bulk_import_subscribers(db, entries)
+        logger.info("Imported subscribers",
+                    extra={'inserted': inserted, 'duplicates': duplicates, 'invalid': invalid})
         return jsonify({
-            'count': len(subscribers),
-            'subscribers': subscribers
+            'inserted': inserted,
+            'duplicates': duplicates,
+            'invalid': invalid
         })
     except Exception as e:
-        error_msg = f"Error getting subscribers: {str(e)}\nType: {type(e)}"
-        print(error_msg)
-        traceback.print_exc()
+        error_msg = f"Error importing subscribers: {str(e)}\nType: {type(e)}"
+        logger.exception("Error importing subscribers")
         return jsonify({'error': error_msg}), 500
 
+class _CSVBuffer:
+    """Write target for csv.writer that hands back whatever was just written"""
+
+    def write(self, value):
+        return value
+
 @app.route('/subscribers/export', methods=['GET'])
 def export_subscribers():
     try:
@@ -568,31 +1868,112 @@ def export_subscribers():
         if not secret_key or secret_key != os.getenv('ADMIN_KEY'):
             return jsonify({'error': 'Unauthorized'}), 401
 
-        # Get fresh DB connection
         db = get_db()
         if db is None:
             return jsonify({'error': 'Database not connected'}), 500
 
-        subscribers = list(db.subscribers.find(
-            {'status': 'active'}, 
-            {'_id': 0, 'email': 1, 'timestamp': 1}
-        ))
-        
-        # Create CSV-formatted string
-        csv_data = "Email,Timestamp\n"
-        for sub in subscribers:
-            csv_data += f"{sub['email']},{sub['timestamp']}\n"
-        
+        cursor = (db.subscribers.find({'status': 'active'}, {'_id': 0, 'email': 1, 'timestamp': 1})
+                  .sort('timestamp', ASCENDING)
+                  .batch_size(1000))
+
+        def generate():
+            writer = csv.writer(_CSVBuffer(), lineterminator='\n')
+            yield writer.writerow(['Email', 'Timestamp'])
+            try:
+                for sub in cursor:
+                    yield writer.writerow([sub['email'], sub['timestamp']])
+            except Exception as e:
+                # Headers are already sent, so all we can do is stop the download
+                logger.exception("Error streaming subscribers export")
+            finally:
+                cursor.close()
+
         # Return as downloadable CSV
-        return csv_data, 200, {
-            'Content-Type': 'text/csv',
+        return Response(stream_with_context(generate()), mimetype='text/csv', headers={
             'Content-Disposition': 'attachment; filename=subscribers.csv'
-        }
+        })
     except Exception as e:
         error_msg = f"Error exporting subscribers: {str(e)}\nType: {type(e)}"
-        print(error_msg)
-        traceback.print_exc()
+        logger.exception("Error exporting subscribers")
         return jsonify({'error': error_msg}), 500
 
+# Warm-up at import: 'off' (the default; everything loads on first use),
+# 'sync' (before the import returns) or 'background' (in a daemon thread)
+WARM_UP_ON_START = os.getenv('WARM_UP_ON_START', 'off').lower()
+
+def _import_pdf_reader():
+    import PyPDF2
+
+# (name, step, environment variables the step needs)
+_WARM_UP_STEPS = (
+    # The gpt-4 encoding, read from the bundled BPE file
+    ('encoding', get_encoding, ()),
+    ('pdf', _import_pdf_reader, ()),
+    ('llm_client', get_client, ('OPENAI_API_KEY', 'OPENAI_BASE_URL')),
+    ('mongodb', get_mongo_client, ('MONGODB_URI',))
+)
+
+def warm_up(steps=None):
+    """Load what the first requests would otherwise load on demand, then log the startup report.
+
+    ``steps`` picks from 'encoding', 'pdf', 'llm_client' and 'mongodb' (default
+    all). Steps for services that are not configured are skipped, and a step
+    that fails is logged and skipped. Returns the seconds each step took.
+    """
+    timings = {}
+    for name, step, required in _WARM_UP_STEPS:
+        if steps is not None and name not in steps:
+            continue
+        if not all(os.getenv(variable) for variable in required):
+            continue
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logger.warning("Warm-up step failed", extra={'step': name, 'error': str(e)})
+            continue
+        timings[name] = time.perf_counter() - started
+        metrics.STARTUP_SECONDS.set(timings[name], phase=f'warm_up_{name}')
+    startup_report(warm_up=timings)
+    return timings
+
+def startup_report(**phases):
+    """Log how long startup took and what is configured and already loaded"""
+    logger.info("Startup report", extra={
+        'import_seconds': round(IMPORT_SECONDS, 3),
+        **{f'{phase}_seconds': {name: round(seconds, 3) for name, seconds in timings.items()}
+           for phase, timings in phases.items()},
+        'preloaded': [module for module in ('PyPDF2', 'requests', 'tiktoken') if module in sys.modules],
+        'openai_api_key_set': bool(os.getenv('OPENAI_API_KEY')),
+        'openai_base_url_set': bool(os.getenv('OPENAI_BASE_URL')),
+        'openai_org_id_set': bool(os.getenv('OPENAI_ORG_ID')),
+        'mongodb_uri_set': bool(os.getenv('MONGODB_URI'))
+    })
+
+_first_response_recorded = False
+
+@app.after_request
+def record_first_response(response):
+    global _first_response_recorded
+    if not _first_response_recorded:
+        _first_response_recorded = True
+        seconds = time.perf_counter() - _import_started
+        metrics.STARTUP_SECONDS.set(seconds, phase='first_response')
+        logger.info("First response", extra={'seconds_since_import': round(seconds, 3),
+                                             'endpoint': request.path})
+    return response
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+metrics.STARTUP_SECONDS.set(IMPORT_SECONDS, phase='import')
+
+if WARM_UP_ON_START == 'sync':
+    warm_up()
+elif WARM_UP_ON_START == 'background':
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+else:
+    startup_report()
+
 if __name__ == '__main__':
+    if WARM_UP_ON_START == 'off':
+        warm_up()
     app.run(debug=True, port=9000)
@@ -0,0 +1,421 @@
+"""ASGI entry point with asyncio versions of /analyze and /upload.
+
+Run with ``uvicorn async_app:app``. In this mode an analysis waiting on the
+LLM or MongoDB holds a coroutine rather than a thread, so one process can
+keep hundreds of analyses in flight, bounded by memory and by the shared
+LLM rate limits. Every other route, and job mode, is served by the Flask
+app, which runs unchanged in the ASGI server's thread pool.
+"""
+import asyncio
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import weakref
+from urllib.parse import parse_qs
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+from motor.motor_asyncio import AsyncIOMotorClient
+from werkzeug.formparser import parse_form_data
+
+import metrics
+from analysis_records import ANALYSIS_FUNCTION, CHUNK_ANALYSIS_FUNCTION, REPLACEMENTS_FUNCTION, Analysis
+from app import (ANALYSIS_CONCURRENCY, MAX_INFLIGHT_ASYNC_ANALYSES, MAX_UPLOAD_BYTES, MONGODB_MAX_POOL_SIZE,
+                 PDF_SPOOL_MAX_BYTES, UPLOAD_TOO_LARGE_MESSAGE, AdmissionRejected, AnalysisRun, MongoCommandTimer,
+                 acquire_analysis_slot, analysis_cache, analysis_cache_key, analysis_document, apply_replacements,
+                 check_pdf_admission, check_text_admission, chunk_messages, chunk_stage_error, comp_validation_failed,
+                 comps_to_replace, compile_messages, existing_analysis_query, get_db, ground_comps, prepare_chunks,
+                 process_pdf, reduce_rounds, release_analysis_slot, replacement_messages)
+from app import app as flask_app
+from async_llm_client import get_async_client
+from cache import hash_text
+from structured_logging import new_request_id, request_id_var
+
+logger = logging.getLogger(__name__)
+
+_motor_clients = weakref.WeakKeyDictionary()
+
+# Coroutine-bound analyses are far cheaper than the Flask app's thread-bound ones
+_async_analysis_slots = threading.BoundedSemaphore(max(MAX_INFLIGHT_ASYNC_ANALYSES, 1))
+
+def get_async_db():
+    """Get the manuscript_analysis database through a motor client for the running loop"""
+    loop = asyncio.get_running_loop()
+    client = _motor_clients.get(loop)
+    if client is None:
+        mongodb_uri = os.getenv('MONGODB_URI')
+        if not mongodb_uri:
+            error_msg = "Error: MONGODB_URI not set in environment variables"
+            logger.error(error_msg)
+            raise Exception(error_msg)
+        client = _motor_clients[loop] = AsyncIOMotorClient(mongodb_uri,
+                                                           maxPoolSize=MONGODB_MAX_POOL_SIZE,
+                                                           event_listeners=[MongoCommandTimer()],
+                                                           serverSelectionTimeoutMS=5000,
+                                                           connectTimeoutMS=5000,
+                                                           socketTimeoutMS=5000)
+    return client.manuscript_analysis
+
+def _async_analysis_cache_collection():
+    # Skip the persistent tier entirely when MongoDB is not configured
+    if not os.getenv('MONGODB_URI'):
+        return None
+    return get_async_db().analysis_cache
+
+analysis_cache.async_collection_getter = _async_analysis_cache_collection
+
+async def gather_limited(function, items, limit):
+    """Await ``function(item)`` for every item, at most ``limit`` at once, returning results in order.
+
+    The first failure cancels every call still running or waiting and is re-raised.
+    """
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run(item):
+        async with semaphore:
+            return await function(item)
+
+    tasks = [asyncio.ensure_future(run(item)) for item in items]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def analyze_chunk_async(chunk, time_range):
+    try:
+        try:
+            reply = await get_async_client().chat(chunk_messages(chunk, time_range), max_tokens=1000,
+                                                  function=CHUNK_ANALYSIS_FUNCTION)
+        except httpx.TimeoutException:
+            raise Exception("The analysis is taking longer than expected. Please try again with a shorter text.")
+        except httpx.HTTPError as e:
+            raise Exception(f"Error communicating with the analysis service: {str(e)}")
+
+        logger.debug("Analyzed chunk", extra={'chunk_chars': len(chunk), 'sample': True})
+        return ground_comps(Analysis.from_reply(reply))
+
+    except Exception as e:
+        logger.exception("Error analyzing chunk")
+        raise
+
+async def analyze_chunk_cached_async(chunk, time_range):
+    """analyze_chunk_async behind the per-chunk level of the analysis cache"""
+    key = analysis_cache_key('chunk', chunk, time_range)
+    cached = await analysis_cache.aget(key) if key else None
+    if cached is not None:
+        return Analysis.loads(cached)
+    analysis = await analyze_chunk_async(chunk, time_range)
+    if key:
+        await analysis_cache.aset(key, analysis.dumps())
+    return analysis
+
+async def compile_analysis_async(chunk_analyses):
+    """compile_analysis with each group compiled as a coroutine"""
+    try:
+        client = get_async_client()
+
+        async def compile_group(analyses):
+            reply = await client.chat(compile_messages(analyses), max_tokens=1500, function=ANALYSIS_FUNCTION)
+            return Analysis.from_reply(reply)
+
+        rounds = reduce_rounds(chunk_analyses)
+        compiled = None
+        while True:
+            try:
+                groups = rounds.send(compiled)
+            except StopIteration as done:
+                return await compile_group(done.value)
+            compiled = await gather_limited(compile_group, groups, ANALYSIS_CONCURRENCY)
+
+    except Exception as e:
+        logger.exception("Error compiling analysis")
+        raise
+
+async def validate_and_fix_comps_async(analysis, time_range):
+    stale = comps_to_replace(analysis, time_range)
+    if not stale:
+        return analysis
+
+    try:
+        reply = await get_async_client().chat(replacement_messages(analysis, stale), max_tokens=1000,
+                                              function=REPLACEMENTS_FUNCTION)
+        return apply_replacements(analysis, stale, reply)
+    except Exception as e:
+        return comp_validation_failed(analysis, e)
+
+async def analyze_text_structured_async(text, time_range='all', details=None):
+    """analyze_text_structured for the event loop: same caching, dedup and details.
+
+    Chunks are analyzed concurrently, at most ANALYSIS_CONCURRENCY at a time;
+    chunking itself is CPU-bound and runs in a worker thread.
+    """
+    details = {} if details is None else details
+    run = AnalysisRun(text, time_range, details)
+    if run.cache_key:
+        cached = run.cache_hit(await analysis_cache.aget(run.cache_key))
+        if cached is not None:
+            return cached
+
+    chunks = await asyncio.to_thread(prepare_chunks, text, time_range, details)
+    run.stage_done('preparing')
+
+    try:
+        all_analyses = await gather_limited(lambda chunk: analyze_chunk_cached_async(chunk, time_range), chunks,
+                                            ANALYSIS_CONCURRENCY)
+    except Exception as e:
+        raise chunk_stage_error(e, httpx.TimeoutException, httpx.HTTPError)
+    run.chunks_done(all_analyses)
+
+    with metrics.COMPILE_SECONDS.time():
+        final_analysis = await compile_analysis_async(all_analyses)
+    run.stage_done('compile')
+    # Checked once on the compiled result rather than on every chunk
+    final_analysis = await validate_and_fix_comps_async(ground_comps(final_analysis), time_range)
+    run.stage_done('validation')
+    cached = run.finish(final_analysis)
+    if cached:
+        await analysis_cache.aset(run.cache_key, cached)
+    return final_analysis
+
+async def store_analysis_async(text, time_range, analysis, details):
+    """store_analysis through motor"""
+    try:
+        db = get_async_db()
+        text_hash = hash_text(text)
+        if details.get('cached'):
+            existing = await db.analyses.find_one(**existing_analysis_query(text_hash, time_range))
+            if existing is not None:
+                return str(existing['_id'])
+
+        document = analysis_document(text_hash, time_range, analysis, details)
+        return str((await db.analyses.insert_one(document)).inserted_id)
+    except Exception as e:
+        logger.error("Error storing analysis: %s", e)
+        return None
+
+async def analyze_and_store_async(text, time_range='all', details=None):
+    """analyze_and_store for the event loop, returning (rendered text, result id)"""
+    details = {} if details is None else details
+    analysis = await analyze_text_structured_async(text, time_range, details=details)
+    return analysis.render(), await store_analysis_async(text, time_range, analysis, details)
+
+def _upload_too_large():
+    metrics.ADMISSION_REJECTED.inc(reason='size')
+    return AdmissionRejected(UPLOAD_TOO_LARGE_MESSAGE, 413)
+
+async def read_body(receive, spool=None):
+    """Read the request body into memory, or into ``spool`` (a binary file) if given.
+
+    Bodies over MAX_UPLOAD_BYTES are rejected as soon as they cross it.
+    """
+    body = spool if spool is not None else io.BytesIO()
+    size = 0
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionError("Client disconnected")
+        size += len(message.get('body', b''))
+        if size > MAX_UPLOAD_BYTES:
+            raise _upload_too_large()
+        body.write(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    if spool is not None:
+        spool.seek(0)
+        return spool
+    return body.getvalue()
+
+def replay(body, receive):
+    """An ASGI receive callable that yields an already-read body first"""
+    sent = False
+
+    async def receive_again():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        return await receive()
+
+    return receive_again
+
+async def send_json(send, data, status=200, headers=()):
+    body = json.dumps(data).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode('ascii'))] + list(headers)
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+def _header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+class ToFlask:
+    """Returned by an async endpoint to serve the request with the Flask app instead"""
+
+    def __init__(self, receive):
+        self.receive = receive
+
+async def analyze_endpoint(scope, query, receive):
+    """Returns (status, payload), or ToFlask for job mode"""
+    body = await read_body(receive)
+    try:
+        data = json.loads(body or b'null')
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return 500, {'error': 'Request body must be a JSON object'}
+
+    mode = query.get('mode', [data.get('mode')])[0]
+    if mode == 'job':
+        return ToFlask(replay(body, receive))
+
+    text = data.get('text', '')
+    time_range = data.get('timeRange', 'all')
+    if not text:
+        return 400, {'error': 'No text provided'}
+
+    check_text_admission(text)
+    acquire_analysis_slot(_async_analysis_slots)
+    try:
+        analysis, result_id = await analyze_and_store_async(text, time_range)
+    finally:
+        release_analysis_slot(_async_analysis_slots)
+    return 200, {'result': analysis, 'resultId': result_id}
+
+async def upload_endpoint(scope, query, receive):
+    """Returns (status, payload), or ToFlask for job mode"""
+    if query.get('mode', [None])[0] == 'job':
+        return ToFlask(receive)
+
+    if int(_header(scope, b'content-length') or 0) > MAX_UPLOAD_BYTES:
+        raise _upload_too_large()
+    spooled = await read_body(receive, tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_BYTES))
+    try:
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': _header(scope, b'content-type') or '',
+            'CONTENT_LENGTH': _header(scope, b'content-length') or '',
+            'wsgi.input': spooled
+        }
+        _, form, files = await asyncio.to_thread(parse_form_data, environ)
+        if form.get('mode') == 'job':
+            spooled.seek(0)
+            return ToFlask(replay(spooled.read(), receive))
+
+        if 'file' not in files:
+            return 400, {'error': 'No file provided'}
+
+        file = files['file']
+        time_range = form.get('timeRange', 'all')
+
+        if file.filename == '':
+            return 400, {'error': 'No file selected'}
+
+        if not file.filename.endswith('.pdf'):
+            return 400, {'error': 'File must be a PDF'}
+
+        # Page and token limits are checked before the slot is taken or the full extraction runs
+        await asyncio.to_thread(check_pdf_admission, file.stream)
+        acquire_analysis_slot(_async_analysis_slots)
+        try:
+            # Extraction is CPU-bound (large PDFs use the process pool)
+            pdf_details = {}
+            pdf_text = await asyncio.to_thread(process_pdf, file, pdf_details)
+
+            if not pdf_text.strip():
+                return 400, {'error': 'Could not extract text from PDF'}
+
+            check_text_admission(pdf_text)
+            analysis, result_id = await analyze_and_store_async(pdf_text, time_range, details=pdf_details)
+        finally:
+            release_analysis_slot(_async_analysis_slots)
+        return 200, {'result': analysis, 'resultId': result_id}
+    finally:
+        spooled.close()
+
+ASYNC_ROUTES = {
+    ('POST', '/analyze'): analyze_endpoint,
+    ('POST', '/upload'): upload_endpoint
+}
+
+flask_asgi = WsgiToAsgi(flask_app)
+
+async def handle_async_route(handler, scope, receive, send):
+    """Run an async endpoint with the request id and metrics the Flask hooks provide"""
+    request_id = _header(scope, b'x-request-id') or new_request_id()
+    token = request_id_var.set(request_id)
+    headers = [(b'x-request-id', request_id.encode('latin-1'))]
+    endpoint = scope['path']
+    started = time.perf_counter()
+    metrics.HTTP_REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+    try:
+        try:
+            response = await handler(scope, parse_qs(scope.get('query_string', b'').decode('latin-1')), receive)
+        except ConnectionError:
+            return
+        except AdmissionRejected as e:
+            response = e.status_code, {'error': str(e)}
+            if e.retry_after is not None:
+                response[1]['retryAfter'] = e.retry_after
+                headers.append((b'retry-after', str(e.retry_after).encode('ascii')))
+        except Exception as e:
+            response = 500, {'error': str(e)}
+        if not isinstance(response, ToFlask):
+            status, payload = response
+            await send_json(send, payload, status, headers=headers)
+            metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, status=status)
+    finally:
+        metrics.HTTP_REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+        request_id_var.reset(token)
+    if isinstance(response, ToFlask):
+        # Flask's own hooks assign the request id and record metrics
+        await flask_asgi(scope, response.receive, send)
+
+def _prepare_storage():
+    # Indexes (including the cache's TTL index) are created through the sync client
+    if not os.getenv('MONGODB_URI'):
+        return
+    try:
+        get_db()
+        analysis_cache.ensure_index()
+    except Exception as e:
+        logger.warning("MongoDB indexes not ensured at startup: %s", e)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await asyncio.to_thread(_prepare_storage)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            loop = asyncio.get_running_loop()
+            client = _motor_clients.pop(loop, None)
+            if client is not None:
+                client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    handler = ASYNC_ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+    if handler is None:
+        await flask_asgi(scope, receive, send)
+        return
+    await handle_async_route(handler, scope, receive, send)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run('async_app:app', port=9000)
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import threading
+import time
+import weakref
+
+import httpx
+
+from llm_client import (RETRYABLE_STATUSES, STREAM_DONE, LLMError, api_error, backoff_delay,
+                        build_chat_request, get_client, parse_stream_line)
+from metrics import LLM_REQUEST_SECONDS
+
+logger = logging.getLogger(__name__)
+
+class AsyncConcurrencyLimiter:
+    """asyncio version of AdaptiveConcurrencyLimiter, with the same AIMD rules"""
+
+    def __init__(self, initial, minimum=1, maximum=None):
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.limit = float(max(minimum, min(initial, self.maximum)))
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, throttled=False):
+        async with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(float(self.minimum), self.limit / 2)
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+class AsyncLLMClient:
+    """Chat completion client for coroutines, built on httpx.
+
+    It shares the process's LLMClient configuration, rate-limit buckets,
+    429 pause and stats, so sync and async callers stay within the same
+    requests- and tokens-per-minute budget. Waiting is done with
+    ``asyncio.sleep``, so a throttled call holds no thread. In-flight
+    requests have their own adaptive limit of the same size. 429s, 5xx
+    responses and read timeouts share the sync client's ``max_retries``
+    budget.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.stats = base.stats
+        self.concurrency = AsyncConcurrencyLimiter(int(base.concurrency.maximum),
+                                                   maximum=int(base.concurrency.maximum))
+        self.http = httpx.AsyncClient(
+            headers=base.headers,
+            timeout=base.timeout,
+            limits=httpx.Limits(max_connections=base.pool_size, max_keepalive_connections=base.pool_size),
+            # Retries failed connection attempts only; everything else is retried by post()
+            transport=httpx.AsyncHTTPTransport(retries=3)
+        )
+
+    async def _acquire_budget(self, tokens):
+        while True:
+            remaining = self.base.pause_remaining()
+            if remaining:
+                await asyncio.sleep(remaining)
+                continue
+            for bucket, amount in ((self.base.request_bucket, 1), (self.base.token_bucket, tokens)):
+                wait = bucket.try_acquire(amount)
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = bucket.try_acquire(amount)
+            return
+
+    async def post(self, data, timeout=None, stream=False):
+        """POST a chat completion request through the limiter, returning the response"""
+        tokens = self.base.estimate_tokens(data)
+        for attempt in range(self.base.max_retries + 1):
+            await self._acquire_budget(tokens)
+
+            await self.concurrency.acquire()
+            throttled = False
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                self.stats.add('requests')
+                request = self.http.build_request('POST', self.base.endpoint, json=data,
+                                                  timeout=timeout or self.base.timeout)
+                response = await self.http.send(request, stream=stream)
+                status = str(response.status_code)
+                throttled = response.status_code == 429
+            except httpx.ReadTimeout:
+                status = 'timeout'
+                if attempt == self.base.max_retries:
+                    raise
+                response = None
+            finally:
+                LLM_REQUEST_SECONDS.observe(time.perf_counter() - started, status=status)
+                await self.concurrency.release(throttled=throttled)
+
+            if response is not None and (response.status_code not in RETRYABLE_STATUSES
+                                         or attempt == self.base.max_retries):
+                return response
+
+            if throttled:
+                delay = self.base.retry_delay(response, attempt)
+                await response.aclose()
+                self.base.pause(delay)
+                continue
+            logger.warning("LLM request failed, retrying", extra={'status': status, 'attempt': attempt + 1})
+            if response is not None:
+                await response.aclose()
+            await asyncio.sleep(backoff_delay(attempt))
+
+    async def chat(self, messages, max_tokens, temperature=0.7, model='gpt-4',
+                   timeout=None, on_token=None, function=None):
+        """Async LLMClient.chat: same arguments, retries and return value"""
+        data = build_chat_request(messages, max_tokens, temperature, model, function, stream=bool(on_token))
+
+        try:
+            response = await self.post(data, timeout=timeout, stream=bool(on_token))
+        except httpx.HTTPError:
+            self.stats.add('errors')
+            raise
+
+        try:
+            if response.status_code != 200:
+                self.stats.add('errors')
+                await response.aread()
+                raise api_error(response)
+
+            if on_token:
+                parts = []
+                async for line in response.aiter_lines():
+                    delta = parse_stream_line(line)
+                    if delta is STREAM_DONE:
+                        break
+                    if delta:
+                        parts.append(delta)
+                        on_token(delta)
+                return ''.join(parts)
+
+            try:
+                response_data = response.json()
+            except ValueError:
+                raise LLMError("Unexpected response format from API", response.status_code)
+            return self.base.read_reply(response.status_code, response_data)
+        finally:
+            await response.aclose()
+
+    async def aclose(self):
+        await self.http.aclose()
+
+_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+def get_async_client():
+    """Get the AsyncLLMClient for the running event loop.
+
+    httpx connections belong to the loop that opened them, so each loop gets
+    its own client over the process-wide LLMClient.
+    """
+    loop = asyncio.get_running_loop()
+    base = get_client()
+    with _clients_lock:
+        client = _clients.get(loop)
+        if client is None or client.base is not base:
+            client = _clients[loop] = AsyncLLMClient(base)
+        return client
@@ -0,0 +1,76 @@
+"""Micro-benchmark: split_text_into_chunks against the original per-token loop.
+
+Run from the repository root:
+
+    python benchmarks/bench_chunker.py --tokens 150000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import get_encoding, split_text_into_chunks
+
+SAMPLE_PARAGRAPH = (
+    "The lighthouse keeper had not spoken to anyone in eleven days. "
+    "She counted the gulls instead, and the ships, and the hours between storms. "
+    "When the letter finally came, it was addressed to someone who had been dead for years.\n\n"
+)
+
+def legacy_split_text_into_chunks(text, max_tokens=3000):
+    """The original implementation, kept for comparison"""
+    encoding = get_encoding()
+    tokens = encoding.encode(text)
+    chunks = []
+    current_chunk = []
+    current_length = 0
+
+    for token in tokens:
+        if current_length >= max_tokens:
+            chunks.append(encoding.decode(current_chunk))
+            current_chunk = []
+            current_length = 0
+        current_chunk.append(token)
+        current_length += 1
+
+    if current_chunk:
+        chunks.append(encoding.decode(current_chunk))
+
+    return chunks
+
+def best_of(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tokens', type=int, default=150000, help='approximate manuscript length in tokens')
+    parser.add_argument('--max-tokens', type=int, default=3000, help='chunk size')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    encoding = get_encoding()
+    paragraph_tokens = len(encoding.encode(SAMPLE_PARAGRAPH))
+    text = SAMPLE_PARAGRAPH * max(1, args.tokens // paragraph_tokens)
+
+    legacy_time, legacy_chunks = best_of(lambda: legacy_split_text_into_chunks(text, args.max_tokens), args.repeat)
+    sliced_time, sliced_chunks = best_of(
+        lambda: split_text_into_chunks(text, args.max_tokens, overlap=0, snap_to_breaks=False), args.repeat)
+    snapped_time, snapped_chunks = best_of(
+        lambda: split_text_into_chunks(text, args.max_tokens, snap_to_breaks=True), args.repeat)
+
+    assert sliced_chunks == legacy_chunks, "sliced chunker must match the legacy output"
+
+    print(f"{len(encoding.encode(text))} tokens, chunk size {args.max_tokens}, best of {args.repeat}")
+    print(f"legacy loop:      {legacy_time * 1000:8.1f} ms  ({len(legacy_chunks)} chunks)")
+    print(f"sliced:           {sliced_time * 1000:8.1f} ms  ({len(sliced_chunks)} chunks, {legacy_time / sliced_time:.1f}x)")
+    print(f"sliced + snapped: {snapped_time * 1000:8.1f} ms  ({len(snapped_chunks)} chunks, {legacy_time / snapped_time:.1f}x)")
+
+if __name__ == '__main__':
+    main()
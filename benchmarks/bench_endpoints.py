@@ -0,0 +1,381 @@
+"""End-to-end benchmark: drive the app's endpoints against a stub LLM and MongoDB.
+
+Starts a local fake /v1/chat/completions server (configurable latency, error
+rate and 429 injection), swaps MongoDB for an in-memory mongomock client, serves
+the app on a local port and hits /analyze, /upload (generated PDFs),
+/subscribe and /subscribers/export at each concurrency level. Results are
+written as JSON so runs can be compared between releases.
+
+Requires mongomock (pip install mongomock). Run from the repository root:
+
+    python benchmarks/bench_endpoints.py --concurrency 1,4,16 --output bench.json
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def _comp(title, author, year, category, reason):
+    return {'title': title, 'author': author, 'year': year, 'category': category, 'reason': reason}
+
+STUB_COMPS = [
+    _comp('Piranesi', 'Susanna Clarke', 2020, 'primary', 'Shares an isolated narrator and a slow-burn mystery.'),
+    _comp('The Vanishing Half', 'Brit Bennett', 2020, 'primary', 'Similar family secrets and a dual timeline.'),
+    _comp('Remarkably Bright Creatures', 'Shelby Van Pelt', 2022, 'primary', 'A comparable voice and a small-town setting.'),
+    _comp('Hamnet', "Maggie O'Farrell", 2020, 'thematic', 'Grief and solitude handled with restraint.'),
+    _comp('The Guest List', 'Lucy Foley', 2020, 'genre', 'Literary suspense with a small cast.'),
+    _comp('Klara and the Sun', 'Kazuo Ishiguro', 2021, 'voice', 'Spare, observational first person.'),
+    _comp('The Maid', 'Nita Prose', 2022, 'trope', 'An outsider narrator pulled into a mystery.')
+]
+
+# Function-call arguments returned for each schema the app uses
+STUB_ARGUMENTS = {
+    'record_comparables': {'comps': STUB_COMPS},
+    'record_analysis': {
+        'comps': STUB_COMPS,
+        'score': 7,
+        'strengths': ['Distinctive voice', 'Atmospheric setting', 'Strong hook'],
+        'weaknesses': ['Slow middle', 'Thin secondary cast', 'Abrupt ending'],
+        'genres': ['Literary suspense', 'Mystery'],
+        'audience': 'Adult readers of atmospheric literary mysteries'
+    },
+    'record_replacements': {'replacements': []}
+}
+
+SAMPLE_PARAGRAPH = (
+    "The lighthouse keeper had not spoken to anyone in eleven days. "
+    "She counted the gulls instead, and the ships, and the hours between storms. "
+    "When the letter finally came, it was addressed to someone who had been dead for years.\n\n"
+)
+
+def make_sentences(count, seed=0):
+    """Sentences of shuffled SAMPLE_PARAGRAPH words, varied enough that
+    boilerplate stripping and near-duplicate chunk detection leave them alone"""
+    rng = random.Random(seed)
+    words = SAMPLE_PARAGRAPH.replace('.', '').replace(',', '').split()
+    sentences = []
+    for _ in range(count):
+        rng.shuffle(words)
+        sentences.append(' '.join(words[:rng.randint(10, 20)]).capitalize() + '.')
+    return sentences
+
+def make_text(words, seed=0):
+    """Manuscript text of about ``words`` words in paragraphs of five sentences"""
+    sentences = make_sentences(max(1, words // 15), seed)
+    return '\n\n'.join(' '.join(sentences[start:start + 5]) for start in range(0, len(sentences), 5))
+
+class StubLLM:
+    """Local chat completions server with injected latency, errors and 429s"""
+
+    def __init__(self, latency=0.05, jitter=0.02, error_rate=0.0, throttle_rate=0.0, retry_after=1.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.counts = {'requests': 0, 'errors': 0, 'throttled': 0}
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                stub.handle(self, body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def _roll(self):
+        with self._lock:
+            self.counts['requests'] += 1
+            roll = self._random.random()
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+        return roll, delay
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def _send_json(self, handler, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def handle(self, handler, body):
+        roll, delay = self._roll()
+        if roll < self.throttle_rate:
+            self._count('throttled')
+            self._send_json(handler, 429, {'error': {'message': 'Rate limit reached'}},
+                            {'Retry-After': str(self.retry_after)})
+            return
+        time.sleep(delay)
+        if roll < self.throttle_rate + self.error_rate:
+            self._count('errors')
+            self._send_json(handler, 500, {'error': {'message': 'Injected server error'}})
+            return
+
+        prompt_chars = sum(len(message.get('content') or '') for message in body.get('messages', []))
+        name = ((body.get('tool_choice') or {}).get('function') or {}).get('name')
+        arguments = json.dumps(STUB_ARGUMENTS.get(name, {}))
+        if body.get('stream'):
+            handler.send_response(200)
+            handler.send_header('Content-Type', 'text/event-stream')
+            handler.send_header('Connection', 'close')
+            handler.end_headers()
+            for start in range(0, len(arguments), 40):
+                call = {'index': 0, 'function': {'arguments': arguments[start:start + 40]}}
+                event = {'choices': [{'delta': {'tool_calls': [call]}}]}
+                handler.wfile.write(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+            handler.wfile.write(b"data: [DONE]\n\n")
+            handler.close_connection = True
+            return
+
+        call = {'id': 'call_0', 'type': 'function', 'function': {'name': name, 'arguments': arguments}}
+        self._send_json(handler, 200, {
+            'choices': [{'message': {'role': 'assistant', 'content': None, 'tool_calls': [call]}}],
+            'usage': {'prompt_tokens': prompt_chars // 4, 'completion_tokens': len(arguments) // 4}
+        })
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='stub-llm', daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def make_pdf(pages, lines_per_page=40):
+    """Build a text-only PDF with ``pages`` pages (no dependencies)"""
+    sentences = make_sentences(pages * lines_per_page)
+    font_number = 3 + 2 * pages
+    objects = [
+        '<< /Type /Catalog /Pages 2 0 R >>',
+        '<< /Type /Pages /Kids [{}] /Count {} >>'.format(
+            ' '.join(f'{3 + 2 * page} 0 R' for page in range(pages)), pages)
+    ]
+    for page in range(pages):
+        lines = [f"Page {page + 1}. {sentences[page * lines_per_page + line]}" for line in range(lines_per_page)]
+        text = ' '.join(f"({line.replace('(', '').replace(')', '')}) Tj 0 -14 Td" for line in lines)
+        content = f"BT /F1 11 Tf 50 750 Td {text} ET"
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {4 + 2 * page} 0 R '
+                       f'/Resources << /Font << /F1 {font_number} 0 R >> >> >>')
+        objects.append(f'<< /Length {len(content)} >>\nstream\n{content}\nendstream')
+    objects.append('<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+
+    out = io.BytesIO()
+    out.write(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(f'{number} 0 obj\n{body}\nendobj\n'.encode('latin-1'))
+    xref = out.tell()
+    out.write(f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode('latin-1'))
+    for offset in offsets:
+        out.write(f'{offset:010d} 00000 n \n'.encode('latin-1'))
+    out.write(f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode('latin-1'))
+    return out.getvalue()
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def peak_rss_mb():
+    """High-water RSS of this process and its reaped children, in MB.
+
+    PDF extraction workers stay alive between requests, so they only show up
+    under 'children' once they have exited.
+    """
+    scale = 1 if platform.system() == 'Darwin' else 1024  # ru_maxrss is bytes on macOS, KB elsewhere
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return {'self': round(own / 2 ** 20, 1), 'children': round(children / 2 ** 20, 1)}
+
+def run_scenario(name, make_request, total, concurrency):
+    """Issue ``total`` requests from ``concurrency`` threads and summarize them"""
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def one(index):
+        started = time.perf_counter()
+        try:
+            response = make_request(index)
+            response.content  # Read streamed bodies to the end
+            status = str(response.status_code)
+        except requests.exceptions.RequestException as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total)))
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    ok = statuses.get('200', 0)
+    return {
+        'scenario': name,
+        'concurrency': concurrency,
+        'requests': total,
+        'errors': total - ok,
+        'statuses': statuses,
+        'duration_seconds': round(duration, 3),
+        'throughput_rps': round(total / duration, 2) if duration else None,
+        'latency_seconds': {
+            'p50': round(percentile(latencies, 0.50), 4),
+            'p95': round(percentile(latencies, 0.95), 4),
+            'p99': round(percentile(latencies, 0.99), 4),
+            'max': round(latencies[-1], 4)
+        },
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def parse_ints(value):
+    return [int(part) for part in value.split(',') if part.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=parse_ints, default=[1, 4, 16], help='comma-separated levels')
+    parser.add_argument('--requests', type=int, default=20, help='requests per scenario and level')
+    parser.add_argument('--scenarios', default='analyze,upload,subscribe,export',
+                        help='comma-separated subset of analyze,upload,subscribe,export')
+    parser.add_argument('--text-words', type=int, default=20000, help='manuscript length for /analyze')
+    parser.add_argument('--pdf-pages', type=parse_ints, default=[10, 100, 500], help='PDF sizes for /upload')
+    parser.add_argument('--upload-requests', type=int, default=None,
+                        help='requests per /upload level (default --requests)')
+    parser.add_argument('--llm-latency', type=float, default=0.05, help='stub LLM latency in seconds')
+    parser.add_argument('--llm-jitter', type=float, default=0.02)
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help='fraction of 500 responses')
+    parser.add_argument('--llm-429-rate', type=float, default=0.0, help='fraction of 429 responses')
+    parser.add_argument('--llm-retry-after', type=float, default=1.0, help='Retry-After sent with 429s')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    stub = StubLLM(args.llm_latency, args.llm_jitter, args.llm_error_rate, args.llm_429_rate,
+                   args.llm_retry_after)
+    stub.start()
+
+    # The app reads its configuration at import time
+    admin_key = 'benchmark'
+    os.environ.update({
+        'OPENAI_API_KEY': 'benchmark',
+        'OPENAI_BASE_URL': stub.url,
+        'MONGODB_URI': 'mongodb://benchmark',
+        'ADMIN_KEY': admin_key
+    })
+    # Identical benchmark inputs would otherwise be served from the cache
+    os.environ.setdefault('ANALYSIS_CACHE_ENABLED', 'false')
+    os.environ.setdefault('LLM_REQUESTS_PER_MINUTE', '100000')
+    os.environ.setdefault('LLM_TOKENS_PER_MINUTE', '100000000')
+    os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+    import mongomock
+    from werkzeug.serving import make_server
+
+    import app as greenlight
+
+    mongo = mongomock.MongoClient()
+    greenlight.MongoClient = lambda *args, **kwargs: mongo
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, greenlight.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='app-server', daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    text = make_text(args.text_words)
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=max(args.concurrency)))
+    run_id = int(time.time())
+
+    scenarios = []
+    wanted = set(args.scenarios.split(','))
+    for concurrency in args.concurrency:
+        if 'analyze' in wanted:
+            scenarios.append(run_scenario(
+                'analyze',
+                lambda index: session.post(f"{base_url}/analyze", json={'text': text, 'timeRange': 'all'}),
+                args.requests, concurrency))
+        if 'upload' in wanted:
+            for pages in args.pdf_pages:
+                pdf = make_pdf(pages)
+                result = run_scenario(
+                    f'upload_{pages}_pages',
+                    lambda index: session.post(f"{base_url}/upload", data={'timeRange': 'all'},
+                                               files={'file': ('manuscript.pdf', pdf, 'application/pdf')}),
+                    args.upload_requests or args.requests, concurrency)
+                result['pdf_bytes'] = len(pdf)
+                scenarios.append(result)
+        if 'subscribe' in wanted:
+            scenarios.append(run_scenario(
+                'subscribe',
+                lambda index: session.post(f"{base_url}/subscribe",
+                                           json={'email': f"reader{run_id}-{concurrency}-{index}@example.com"}),
+                args.requests, concurrency))
+        if 'export' in wanted:
+            scenarios.append(run_scenario(
+                'export',
+                lambda index: session.get(f"{base_url}/subscribers/export", params={'key': admin_key}),
+                args.requests, concurrency))
+
+    server.shutdown()
+    stub.stop()
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': {
+            'requests': args.requests,
+            'text_words': args.text_words,
+            'pdf_pages': args.pdf_pages,
+            'llm_latency': args.llm_latency,
+            'llm_jitter': args.llm_jitter,
+            'llm_error_rate': args.llm_error_rate,
+            'llm_429_rate': args.llm_429_rate,
+            'llm_retry_after': args.llm_retry_after
+        },
+        'stub_llm': dict(stub.counts),
+        'subscribers': mongo.manuscript_analysis.subscribers.count_documents({}),
+        'scenarios': scenarios
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+_whitespace_re = re.compile(r'\s+')
+
+def normalize_text(text):
+    """Collapse whitespace so trivially reformatted resubmissions share a key"""
+    return _whitespace_re.sub(' ', text).strip()
+
+def hash_text(text):
+    """SHA-256 of the normalized text, so reformatted resubmissions hash the same"""
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+def make_cache_key(kind, text, time_range, prompt_version):
+    """Build a content-addressed cache key for a piece of text"""
+    digest = hashlib.sha256()
+    for part in (kind, str(prompt_version), time_range, normalize_text(text)):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return f"{kind}:{digest.hexdigest()}"
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with per-entry expiry"""
+
+    def __init__(self, maxsize=256, ttl_seconds=None):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class AnalysisCache:
+    """Two-tier cache: a local LRU in front of a MongoDB collection with TTL expiry.
+
+    ``collection_getter`` returns the MongoDB collection (or None when the
+    persistent tier is unavailable). Persistent tier errors are logged and
+    treated as misses so the cache never fails an analysis, and the tier is
+    then skipped for ``retry_seconds`` so a down MongoDB is not retried on
+    every call. ``aget`` and
+    ``aset`` are the coroutine versions, reading the persistent tier through
+    the motor collection ``async_collection_getter`` returns.
+    """
+
+    def __init__(self, collection_getter=None, maxsize=256, ttl_seconds=7 * 24 * 3600,
+                 async_collection_getter=None, retry_seconds=30):
+        self.local = LRUCache(maxsize=maxsize, ttl_seconds=ttl_seconds)
+        self.collection_getter = collection_getter
+        self.async_collection_getter = async_collection_getter
+        self.ttl_seconds = ttl_seconds
+        self.retry_seconds = retry_seconds
+        self._unavailable_until = 0.0
+        self._indexes_ready = False
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+
+    def _count(self, kind, outcome):
+        with self._stats_lock:
+            kind_stats = self._stats.setdefault(kind, {'local_hits': 0, 'persistent_hits': 0, 'misses': 0})
+            kind_stats[outcome] += 1
+
+    def _persistent_failed(self, action, error):
+        self._unavailable_until = time.monotonic() + self.retry_seconds
+        logger.warning("Analysis cache %s failed, skipping MongoDB for %ss: %s", action, self.retry_seconds, error)
+
+    def _collection(self):
+        if self.collection_getter is None or time.monotonic() < self._unavailable_until:
+            return None
+        collection = self.collection_getter()
+        if collection is not None and not self._indexes_ready:
+            collection.create_index('created_at', expireAfterSeconds=int(self.ttl_seconds))
+            self._indexes_ready = True
+        return collection
+
+    def _async_collection(self):
+        if self.async_collection_getter is None or time.monotonic() < self._unavailable_until:
+            return None
+        return self.async_collection_getter()
+
+    def ensure_index(self):
+        """Create the persistent tier's TTL index now instead of on first use"""
+        self._collection()
+
+    def _get_local(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self._count(key.split(':', 1)[0], 'local_hits')
+        return value
+
+    def _found(self, key, doc):
+        if doc is not None:
+            self.local.set(key, doc['value'])
+            self._count(key.split(':', 1)[0], 'persistent_hits')
+            return doc['value']
+        self._count(key.split(':', 1)[0], 'misses')
+        return None
+
+    def get(self, key):
+        value = self._get_local(key)
+        if value is not None:
+            return value
+
+        try:
+            collection = self._collection()
+            doc = collection.find_one({'_id': key}, {'value': 1}) if collection is not None else None
+        except Exception as e:
+            self._persistent_failed('read', e)
+            doc = None
+        return self._found(key, doc)
+
+    async def aget(self, key):
+        value = self._get_local(key)
+        if value is not None:
+            return value
+
+        try:
+            collection = self._async_collection()
+            doc = await collection.find_one({'_id': key}, {'value': 1}) if collection is not None else None
+        except Exception as e:
+            self._persistent_failed('read', e)
+            doc = None
+        return self._found(key, doc)
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        try:
+            collection = self._collection()
+            if collection is not None:
+                collection.replace_one(
+                    {'_id': key},
+                    {'_id': key, 'value': value, 'created_at': datetime.utcnow()},
+                    upsert=True
+                )
+        except Exception as e:
+            self._persistent_failed('write', e)
+
+    async def aset(self, key, value):
+        # The TTL index comes from ensure_index, run once at startup
+        self.local.set(key, value)
+        try:
+            collection = self._async_collection()
+            if collection is not None:
+                await collection.replace_one(
+                    {'_id': key},
+                    {'_id': key, 'value': value, 'created_at': datetime.utcnow()},
+                    upsert=True
+                )
+        except Exception as e:
+            self._persistent_failed('write', e)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = {kind: dict(counts) for kind, counts in self._stats.items()}
+        stats['local_size'] = len(self.local)
+        return stats
@@ -0,0 +1,104 @@
+import bisect
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+_non_word_re = re.compile(r'[^a-z0-9]+')
+_leading_article_re = re.compile(r'^(?:the|a|an) ')
+
+def normalize_title(title):
+    """Lowercase, drop punctuation and a leading article so near-identical titles match"""
+    title = _non_word_re.sub(' ', title.lower().replace('&', ' and ')).strip()
+    return _leading_article_re.sub('', title)
+
+class CompsCatalog:
+    """Known titles with verified years, indexed by title, genre, trope and year.
+
+    ``entries`` are dicts with 'title', 'author', 'year', 'genres' and
+    'tropes'. Lookups are in-memory: a dict on the normalized title, sets of
+    entry positions per genre and per trope, and a year-sorted list searched
+    with bisect.
+    """
+
+    def __init__(self, entries=()):
+        self.entries = []
+        self._by_title = {}
+        self._by_genre = {}
+        self._by_trope = {}
+        self._years = []  # (year, position), sorted
+
+        for entry in entries:
+            position = len(self.entries)
+            entry = dict(entry,
+                         genres=[genre.lower() for genre in entry.get('genres', [])],
+                         tropes=[trope.lower() for trope in entry.get('tropes', [])])
+            self.entries.append(entry)
+            self._by_title.setdefault(normalize_title(entry['title']), []).append(position)
+            for genre in entry['genres']:
+                self._by_genre.setdefault(genre, set()).add(position)
+            for trope in entry['tropes']:
+                self._by_trope.setdefault(trope, set()).add(position)
+            self._years.append((entry['year'], position))
+        self._years.sort()
+
+    @classmethod
+    def load(cls, path):
+        """Build a catalog from a JSON list; a missing or bad file gives an empty catalog"""
+        try:
+            with open(path, encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Comps catalog not loaded from %s: %s", path, e)
+            entries = []
+        return cls(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, title, author=None):
+        """The entry for a title, or None. ``author`` picks between same-titled books."""
+        positions = self._by_title.get(normalize_title(title))
+        if not positions:
+            return None
+        if author:
+            surname = normalize_title(author).split(' ')[-1]
+            for position in positions:
+                if surname and surname in normalize_title(self.entries[position]['author']):
+                    return self.entries[position]
+            return None
+        return self.entries[positions[0]]
+
+    def candidates(self, genres=(), tropes=(), min_year=None, max_year=None, exclude=(), limit=5):
+        """Entries sharing any of the genres or tropes, best matches first.
+
+        Entries are scored by shared tropes (weighted double) plus shared genres,
+        then by recency, and restricted to [min_year, max_year]. Titles in
+        ``exclude`` are skipped.
+        """
+        genres = {genre.lower() for genre in genres}
+        tropes = {trope.lower() for trope in tropes}
+
+        low = 0 if min_year is None else bisect.bisect_left(self._years, (min_year, -1))
+        high = len(self._years) if max_year is None else bisect.bisect_right(self._years, (max_year, len(self.entries)))
+        in_range = {position for _, position in self._years[low:high]}
+
+        if genres or tropes:
+            matched = set()
+            for genre in genres:
+                matched |= self._by_genre.get(genre, set())
+            for trope in tropes:
+                matched |= self._by_trope.get(trope, set())
+            in_range &= matched
+
+        excluded = {normalize_title(title) for title in exclude}
+        scored = []
+        for position in in_range:
+            entry = self.entries[position]
+            if normalize_title(entry['title']) in excluded:
+                continue
+            score = 2 * len(tropes.intersection(entry['tropes'])) + len(genres.intersection(entry['genres']))
+            scored.append((-score, -entry['year'], position))
+        scored.sort()
+        return [self.entries[position] for _, _, position in scored[:limit]]
@@ -0,0 +1,145 @@
+import hashlib
+import re
+from collections import Counter
+
+_invisible_re = re.compile('[\u00ad\u200b\u200c\u200d\ufeff]')
+_trailing_space_re = re.compile(r'[ \t]+\n')
+_spaces_re = re.compile('[ \t\u00a0]{2,}')
+_blank_lines_re = re.compile(r'\n{3,}')
+_digits_re = re.compile(r'\d+')
+_word_re = re.compile(r'\w+')
+
+def normalize_manuscript(text):
+    """Drop invisible characters and redundant whitespace, keeping paragraph breaks"""
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    text = _invisible_re.sub('', text)
+    text = _spaces_re.sub(' ', text)
+    text = _trailing_space_re.sub('\n', text)
+    return _blank_lines_re.sub('\n\n', text).strip()
+
+def _line_key(line):
+    # Page numbers change from page to page, so "Page 12" and "Page 13" share a key
+    return _digits_re.sub('#', ' '.join(line.lower().split()))
+
+def strip_repeated_lines(pages, edge_lines=3, min_fraction=0.5, min_pages=3, max_length=100):
+    """Remove header and footer lines repeated across pages.
+
+    A line is boilerplate when it is at most ``max_length`` characters and,
+    ignoring case, whitespace and digits, it is among the first or last
+    ``edge_lines`` non-empty lines of at least ``min_fraction`` of the pages
+    (and at least ``min_pages`` pages). Only those edge positions are
+    stripped. Returns the cleaned pages and the removed lines.
+    """
+    if len(pages) < min_pages:
+        return pages, []
+
+    page_lines = [page.split('\n') for page in pages]
+    edges = []
+    counts = Counter()
+    for lines in page_lines:
+        filled = [index for index, line in enumerate(lines) if line.strip()]
+        positions = {index for index in filled[:edge_lines] + filled[-edge_lines:]
+                     if len(lines[index].strip()) <= max_length}
+        edges.append(positions)
+        counts.update({_line_key(lines[index]) for index in positions})
+
+    threshold = max(min_pages, min_fraction * len(pages))
+    boilerplate = {key for key, count in counts.items() if count >= threshold}
+    if not boilerplate:
+        return pages, []
+
+    cleaned = []
+    removed = []
+    for lines, positions in zip(page_lines, edges):
+        kept = []
+        for index, line in enumerate(lines):
+            if index in positions and _line_key(line) in boilerplate:
+                removed.append(line)
+            else:
+                kept.append(line)
+        cleaned.append('\n'.join(kept))
+    return cleaned, removed
+
+def drop_repeated_paragraphs(text, min_words=12):
+    """Remove exact repeats (ignoring case and whitespace) of paragraphs of at
+    least ``min_words`` words, keeping the first. Returns the text and the
+    removed paragraphs; short ones such as scene breaks are never removed.
+    """
+    seen = set()
+    kept = []
+    removed = []
+    for paragraph in text.split('\n\n'):
+        words = paragraph.lower().split()
+        key = ' '.join(words)
+        if len(words) >= min_words and key in seen:
+            removed.append(paragraph)
+            continue
+        seen.add(key)
+        kept.append(paragraph)
+    return '\n\n'.join(kept), removed
+
+class MinHasher:
+    """One-permutation MinHash signatures over word shingles.
+
+    Each shingle is hashed once and dropped into one of ``num_bins`` bins by
+    its hash; the signature is the minimum per bin. The fraction of bins two
+    signatures agree on estimates the Jaccard similarity of their shingles.
+    """
+
+    _EMPTY = 1 << 64
+
+    def __init__(self, num_bins=64, shingle_size=5):
+        self.num_bins = num_bins
+        self.shingle_size = shingle_size
+
+    def signature(self, text):
+        words = _word_re.findall(text.lower())
+        size = self.shingle_size
+        shingles = {' '.join(words[index:index + size]) for index in range(max(1, len(words) - size + 1))}
+        bins = [self._EMPTY] * self.num_bins
+        for shingle in shingles:
+            value = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+            slot = value % self.num_bins
+            if value < bins[slot]:
+                bins[slot] = value
+        return tuple(bins)
+
+    def similarity(self, first, second):
+        """Estimated Jaccard similarity of two signatures"""
+        compared = agreed = 0
+        for a, b in zip(first, second):
+            if a == self._EMPTY and b == self._EMPTY:
+                continue
+            compared += 1
+            agreed += a == b
+        return agreed / compared if compared else 1.0
+
+def find_duplicate_chunks(chunks, threshold=0.9, hasher=None, rows_per_band=4):
+    """Map the index of every near-duplicate chunk to the earlier chunk it repeats.
+
+    Signatures are split into bands of ``rows_per_band`` bins; chunks sharing
+    any band are candidates, and a candidate is a duplicate when its
+    estimated similarity is at least ``threshold``.
+    """
+    hasher = hasher or MinHasher()
+    signatures = []
+    buckets = {}
+    duplicates = {}
+    for index, chunk in enumerate(chunks):
+        signature = hasher.signature(chunk)
+        signatures.append(signature)
+        bands = [(start, signature[start:start + rows_per_band])
+                 for start in range(0, len(signature), rows_per_band)]
+
+        candidates = []
+        for band in bands:
+            candidates.extend(buckets.get(band, ()))
+        for candidate in dict.fromkeys(candidates):
+            if hasher.similarity(signature, signatures[candidate]) >= threshold:
+                duplicates[index] = candidate
+                break
+        else:
+            # Only unique chunks are bucketed, so duplicates point at an original
+            for band in bands:
+                buckets.setdefault(band, []).append(index)
+    return duplicates
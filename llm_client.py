@@ -0,0 +1,469 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from metrics import LLM_REQUEST_SECONDS, LLM_THROTTLED, LLM_TOKENS
+
+logger = logging.getLogger(__name__)
+
+# requests and tiktoken are imported on first use to keep startup fast
+
+# The gpt-4 (cl100k_base) BPE ranks, bundled in tiktoken's cache layout (the
+# file is named for the SHA-1 of its download URL) so loading never needs the network
+BUNDLED_ENCODING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'tiktoken')
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model="gpt-4"):
+    """Get the tiktoken encoding for a model, loaded once per process.
+
+    Encodings are read from BUNDLED_ENCODING_DIR unless TIKTOKEN_CACHE_DIR
+    points somewhere else.
+    """
+    os.environ.setdefault('TIKTOKEN_CACHE_DIR', BUNDLED_ENCODING_DIR)
+    import tiktoken
+    return tiktoken.encoding_for_model(model)
+
+def count_tokens(text):
+    """Count gpt-4 tokens in text"""
+    return len(get_encoding().encode(text))
+
+class LLMError(Exception):
+    """A chat completion request that came back with a non-200 status"""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+def parse_retry_after(value, now=None):
+    """Parse a Retry-After header (seconds or HTTP date) into seconds to wait"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = now or datetime.now(timezone.utc)
+    return max(0.0, (retry_at - now).total_seconds())
+
+# Statuses post() retries: rate limiting and transient server errors
+RETRYABLE_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+def backoff_delay(attempt):
+    """Exponential backoff for a retry that has no Retry-After to go by"""
+    return min(2 ** attempt, 30)
+
+class TokenBucket:
+    """Token bucket refilled continuously at ``rate_per_minute``.
+
+    ``acquire`` blocks until enough tokens are available. Requests larger than
+    the bucket are clamped to its capacity so they can still proceed.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(capacity if capacity is not None else rate_per_minute)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, amount=1):
+        """Take ``amount`` tokens if available, returning 0, or else the seconds to wait"""
+        amount = min(float(amount), self.capacity)
+        with self._lock:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.rate
+
+    def acquire(self, amount=1):
+        while True:
+            wait = self.try_acquire(amount)
+            if not wait:
+                return
+            self.sleep(wait)
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD limit on in-flight requests.
+
+    Each success grows the limit by 1/limit (about +1 per round of requests);
+    each throttled response halves it. The limit stays within
+    [minimum, maximum].
+    """
+
+    def __init__(self, initial, minimum=1, maximum=None):
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.limit = float(max(minimum, min(initial, self.maximum)))
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def _adjust(self, throttled):
+        self.in_flight -= 1
+        if throttled:
+            self.limit = max(float(self.minimum), self.limit / 2)
+        else:
+            self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+
+    def release(self, throttled=False):
+        with self._condition:
+            self._adjust(throttled)
+            self._condition.notify_all()
+
+class ClientStats:
+    """Thread-safe counters describing how an LLMClient is being used"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {
+            'requests': 0,
+            'connections_opened': 0,
+            'throttled': 0,
+            'errors': 0,
+            'prompt_tokens': 0,
+            'completion_tokens': 0
+        }
+
+    def add(self, name, amount=1):
+        with self._lock:
+            self.counts[name] += amount
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self.counts)
+        if counts['requests']:
+            counts['connection_reuse_rate'] = max(0.0, 1 - counts['connections_opened'] / counts['requests'])
+        else:
+            counts['connection_reuse_rate'] = None
+        return counts
+
+@functools.lru_cache(maxsize=None)
+def _counting_adapter_class():
+    import requests
+
+    class CountingHTTPAdapter(requests.adapters.HTTPAdapter):
+        """HTTPAdapter that counts every new TCP/TLS connection its pools open"""
+
+        def __init__(self, stats, *args, **kwargs):
+            self.stats = stats
+            super().__init__(*args, **kwargs)
+
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            stats = self.stats
+            pool_classes = {}
+            for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items():
+                class CountingPool(pool_class):
+                    def _new_conn(self):
+                        stats.add('connections_opened')
+                        return super()._new_conn()
+                pool_classes[scheme] = CountingPool
+            self.poolmanager.pool_classes_by_scheme = pool_classes
+
+    return CountingHTTPAdapter
+
+class LLMClient:
+    """Chat completion client shared by every call site in the process.
+
+    Configuration, headers and a keep-alive connection pool are set up once.
+    Every call waits on a requests-per-minute bucket, a tokens-per-minute
+    bucket (charged with the prompt's token count plus ``max_tokens``) and an
+    adaptive concurrency limit. ``post`` is the one retry layer: 429s, 5xx
+    responses and timeouts share a budget of ``max_retries`` retries. A 429
+    pauses all callers for its Retry-After and halves the concurrency limit;
+    the others back off exponentially. The connection pool only retries
+    failed connection attempts, which never reached the server.
+    """
+
+    def __init__(self, api_key, base_url, org_id=None, requests_per_minute=500,
+                 tokens_per_minute=150000, max_concurrency=8, max_retries=4,
+                 timeout=60, pool_size=10, count_tokens=count_tokens,
+                 clock=time.monotonic, sleep=time.sleep):
+        import requests
+
+        self.endpoint = f"{base_url.rstrip('/')}/v1/chat/completions"
+        self.headers = {
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'User-Agent': 'ManuscriptAnalysis/1.0'
+        }
+        if org_id:
+            self.headers['X-Organization-ID'] = org_id
+
+        self.stats = ClientStats()
+        self.session = requests.Session()
+        adapter = _counting_adapter_class()(
+            self.stats,
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            # Connection failures only; read timeouts and error statuses are
+            # retried by post(), so the two layers never multiply
+            max_retries=requests.urllib3.Retry(
+                total=3,
+                connect=3,
+                read=False,
+                status=0,
+                other=0,
+                backoff_factor=1,
+                allowed_methods=frozenset(['POST']),
+                raise_on_status=False
+            )
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.request_bucket = TokenBucket(requests_per_minute, clock=clock, sleep=sleep)
+        self.token_bucket = TokenBucket(tokens_per_minute, clock=clock, sleep=sleep)
+        self.concurrency = AdaptiveConcurrencyLimiter(max_concurrency, maximum=max_concurrency)
+        self.count_tokens = count_tokens
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.clock = clock
+        self.sleep = sleep
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def estimate_tokens(self, data):
+        """Tokens a chat completion request will be charged for"""
+        prompt_tokens = sum(self.count_tokens(message.get('content') or '')
+                            for message in data.get('messages', []))
+        if data.get('tools'):
+            prompt_tokens += self.count_tokens(json.dumps(data['tools']))
+        return prompt_tokens + int(data.get('max_tokens') or 0)
+
+    def pause(self, seconds):
+        """Hold back every caller for ``seconds``"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, self.clock() + seconds)
+
+    def pause_remaining(self):
+        """Seconds left on the current pause, or 0"""
+        with self._lock:
+            return max(0.0, self._paused_until - self.clock())
+
+    def _wait_if_paused(self):
+        while True:
+            remaining = self.pause_remaining()
+            if not remaining:
+                return
+            self.sleep(remaining)
+
+    def retry_delay(self, response, attempt):
+        """Record a throttled response and return how long every caller should pause"""
+        self.stats.add('throttled')
+        LLM_THROTTLED.inc()
+        delay = parse_retry_after(response.headers.get('Retry-After'))
+        if delay is None:
+            delay = backoff_delay(attempt)
+        logger.warning("LLM rate limited, retrying", extra={'delay_seconds': round(delay, 1), 'attempt': attempt + 1})
+        return delay
+
+    def post(self, data, timeout=None, stream=False):
+        """POST a chat completion request through the limiter, returning the response.
+
+        429s, 5xx responses and timeouts are retried up to ``max_retries``
+        times in total; the last response is returned, or the last timeout
+        raised, once the budget is spent.
+        """
+        import requests
+
+        tokens = self.estimate_tokens(data)
+        for attempt in range(self.max_retries + 1):
+            self._wait_if_paused()
+            self.request_bucket.acquire(1)
+            self.token_bucket.acquire(tokens)
+
+            self.concurrency.acquire()
+            throttled = False
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                self.stats.add('requests')
+                response = self.session.post(self.endpoint, headers=self.headers, json=data,
+                                             timeout=timeout or self.timeout, stream=stream)
+                status = str(response.status_code)
+                throttled = response.status_code == 429
+            except requests.exceptions.ReadTimeout:
+                # Connect timeouts were already retried by the connection pool
+                status = 'timeout'
+                if attempt == self.max_retries:
+                    raise
+                response = None
+            finally:
+                LLM_REQUEST_SECONDS.observe(time.perf_counter() - started, status=status)
+                self.concurrency.release(throttled=throttled)
+
+            if response is not None and (response.status_code not in RETRYABLE_STATUSES
+                                         or attempt == self.max_retries):
+                return response
+
+            if throttled:
+                delay = self.retry_delay(response, attempt)
+                response.close()
+                self.pause(delay)
+                continue
+            logger.warning("LLM request failed, retrying", extra={'status': status, 'attempt': attempt + 1})
+            if response is not None:
+                response.close()
+            self.sleep(backoff_delay(attempt))
+
+    def chat(self, messages, max_tokens, temperature=0.7, model='gpt-4',
+             timeout=None, on_token=None, function=None):
+        """Run a chat completion and return the message content.
+
+        Retries are left to ``post``. Non-200 responses raise LLMError. With ``on_token`` the completion is streamed
+        and each content delta is passed to it as it arrives. With
+        ``function`` (a name/description/parameters schema) the model is made
+        to call it and the call's JSON arguments are returned instead.
+        """
+        import requests
+
+        data = build_chat_request(messages, max_tokens, temperature, model, function, stream=bool(on_token))
+
+        try:
+            response = self.post(data, timeout=timeout, stream=bool(on_token))
+        except requests.exceptions.RequestException:
+            self.stats.add('errors')
+            raise
+
+        if response.status_code != 200:
+            self.stats.add('errors')
+            raise api_error(response)
+
+        if on_token:
+            return read_streamed_completion(response, on_token)
+
+        return self.read_reply(response.status_code, response.json())
+
+    def read_reply(self, status_code, response_data):
+        """Record a completion's token usage and return its content or function arguments"""
+        usage = response_data.get('usage') or {}
+        self.stats.add('prompt_tokens', usage.get('prompt_tokens', 0))
+        self.stats.add('completion_tokens', usage.get('completion_tokens', 0))
+        LLM_TOKENS.inc(usage.get('prompt_tokens', 0), type='prompt')
+        LLM_TOKENS.inc(usage.get('completion_tokens', 0), type='completion')
+        if not response_data.get('choices'):
+            raise LLMError("Unexpected response format from API", status_code)
+        message = response_data['choices'][0]['message']
+        if message.get('tool_calls'):
+            return message['tool_calls'][0]['function'].get('arguments') or ''
+        return message.get('content') or ''
+
+def build_chat_request(messages, max_tokens, temperature=0.7, model='gpt-4', function=None, stream=False):
+    """Request body for a chat completion, forcing a call to ``function`` if given"""
+    data = {
+        'model': model,
+        'messages': messages,
+        'temperature': temperature,
+        'max_tokens': max_tokens
+    }
+    if function:
+        data['tools'] = [{'type': 'function', 'function': function}]
+        data['tool_choice'] = {'type': 'function', 'function': {'name': function['name']}}
+    if stream:
+        data['stream'] = True
+    return data
+
+def api_error(response):
+    """LLMError describing a non-200 chat completion response"""
+    error_message = f"API Error: {response.status_code}"
+    try:
+        error_data = response.json()
+        if 'error' in error_data:
+            error_message += f" - {error_data['error'].get('message', '')}"
+        else:
+            error_message += f" - {json.dumps(error_data)}"
+    except ValueError:
+        error_message += f" - {response.text}"
+    return LLMError(error_message, response.status_code)
+
+# Returned by parse_stream_line for the end-of-stream marker
+STREAM_DONE = object()
+
+def parse_stream_line(line):
+    """The content (or function argument) delta in one SSE line of a streamed
+    completion, STREAM_DONE at the end, or None"""
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    if not line.startswith('data:'):
+        return None
+    payload = line[len('data:'):].strip()
+    if payload == '[DONE]':
+        return STREAM_DONE
+    choices = json.loads(payload).get('choices') or [{}]
+    delta = choices[0].get('delta', {})
+    tool_calls = delta.get('tool_calls')
+    return tool_calls[0].get('function', {}).get('arguments') if tool_calls else delta.get('content')
+
+def read_streamed_completion(response, on_token):
+    """Collect a streamed chat completion, passing each content (or function
+    argument) delta to on_token. The response is always closed, including
+    when on_token raises to abandon the stream."""
+    parts = []
+    try:
+        for line in response.iter_lines():
+            delta = parse_stream_line(line)
+            if delta is STREAM_DONE:
+                break
+            if delta:
+                parts.append(delta)
+                on_token(delta)
+    finally:
+        response.close()
+    return ''.join(parts)
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Get the process-wide LLMClient, creating it from the environment if necessary.
+
+    Raises if OPENAI_API_KEY or OPENAI_BASE_URL is not set. The client is
+    recreated after a fork so processes never share pooled sockets.
+    """
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            api_key = os.getenv('OPENAI_API_KEY')
+            base_url = os.getenv('OPENAI_BASE_URL')
+            if not api_key or not base_url:
+                raise Exception("API configuration missing")
+
+            _client = LLMClient(
+                api_key,
+                base_url,
+                org_id=os.getenv('OPENAI_ORG_ID'),
+                requests_per_minute=int(os.getenv('LLM_REQUESTS_PER_MINUTE', '500')),
+                tokens_per_minute=int(os.getenv('LLM_TOKENS_PER_MINUTE', '150000')),
+                max_concurrency=int(os.getenv('LLM_MAX_CONCURRENCY', '8')),
+                max_retries=int(os.getenv('LLM_MAX_RETRIES', '4')),
+                timeout=float(os.getenv('LLM_TIMEOUT_SECONDS', '60')),
+                pool_size=int(os.getenv('LLM_POOL_SIZE', '16'))
+            )
+            _client_pid = os.getpid()
+        return _client
@@ -0,0 +1,200 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Default latency buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class _Metric:
+    """Base for metrics holding one value per label set"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{self._format_labels(key)} {value}"]
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track_in_progress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            lines.append(f"{self.name}_bucket{self._format_labels(key, ('le', le))} {cumulative}")
+        lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+        lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+class Registry:
+    """Collection of metrics rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+# Process-wide registry served by /metrics
+registry = Registry()
+
+# Buckets for token-count histograms
+TOKEN_BUCKETS = (100, 500, 1000, 2000, 5000, 10000, 25000, 50000, 100000, 250000)
+
+HTTP_REQUESTS_IN_FLIGHT = registry.gauge(
+    'greenlight_http_requests_in_flight', 'Requests currently being handled', ['endpoint'])
+HTTP_REQUEST_SECONDS = registry.histogram(
+    'greenlight_http_request_seconds', 'Request handling time', ['endpoint', 'status'])
+
+STARTUP_SECONDS = registry.gauge(
+    'greenlight_startup_seconds', 'Time spent in each startup phase (import, warm-up steps, first request)', ['phase'])
+
+PDF_EXTRACTION_SECONDS = registry.histogram(
+    'greenlight_pdf_extraction_seconds', 'Wall-clock time for process_pdf')
+PDF_PAGE_CPU_SECONDS = registry.histogram(
+    'greenlight_pdf_page_cpu_seconds', 'CPU time to extract one PDF page',
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+CHUNKING_SECONDS = registry.histogram(
+    'greenlight_chunking_seconds', 'Time spent in split_text_into_chunks')
+CHUNKING_TOKENS = registry.histogram(
+    'greenlight_chunking_tokens', 'Tokens per document passed to split_text_into_chunks',
+    buckets=TOKEN_BUCKETS)
+CHUNKS_PER_DOCUMENT = registry.histogram(
+    'greenlight_chunks_per_document', 'Chunks produced per document',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200))
+DEDUP_TOKENS_SAVED = registry.counter(
+    'greenlight_dedup_tokens_saved_total', 'Tokens kept out of LLM prompts by pre-analysis dedup', ['stage'])
+
+LLM_REQUEST_SECONDS = registry.histogram(
+    'greenlight_llm_request_seconds', 'Latency of one chat completion HTTP call', ['status'])
+LLM_TOKENS = registry.counter(
+    'greenlight_llm_tokens_total', 'Tokens reported in chat completion usage', ['type'])
+LLM_THROTTLED = registry.counter(
+    'greenlight_llm_throttled_total', 'Chat completion calls rejected with 429')
+
+ANALYSES_IN_FLIGHT = registry.gauge(
+    'greenlight_analyses_in_flight', 'Analyses holding an admission slot')
+ADMISSION_REJECTED = registry.counter(
+    'greenlight_admission_rejected_total', 'Requests turned away by admission control', ['reason'])
+
+COMP_VALIDATION = registry.counter(
+    'greenlight_comp_validation_total', 'validate_and_fix_comps outcomes', ['outcome'])
+COMPILE_SECONDS = registry.histogram(
+    'greenlight_compile_seconds', 'Time spent in compile_analysis')
+
+MONGODB_COMMAND_SECONDS = registry.histogram(
+    'greenlight_mongodb_command_seconds', 'MongoDB command latency', ['command', 'outcome'])
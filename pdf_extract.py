@@ -0,0 +1,21 @@
+import time
+
+def extract_page_range(path, start, end):
+    """Extract (text, cpu_seconds) for pages [start, end) of the PDF at path.
+
+    Kept out of app.py so pool workers can unpickle it by module name.
+    Spawned workers still re-import the parent's ``__main__`` (app.py when
+    run as ``python app.py``, the server otherwise), which is cheap since
+    app.py imports its heavy dependencies lazily.
+    """
+    import PyPDF2
+
+    pdf_reader = PyPDF2.PdfReader(path)
+    return [extract_page(pdf_reader.pages[number]) for number in range(start, end)]
+
+def extract_page(page):
+    """Extract a page's text along with the CPU time it took on this thread"""
+    # Per-thread, so other requests' threads don't inflate the timing
+    started = time.thread_time()
+    text = page.extract_text() or ""
+    return text, time.thread_time() - started
@@ -0,0 +1,126 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import uuid
+from datetime import datetime, timezone
+
+# Correlation id of the request (or job) the current code is running for.
+# Worker threads only see it if they are started with contextvars.copy_context().
+request_id_var = contextvars.ContextVar('request_id', default=None)
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+# Attributes every LogRecord has; anything else came from extra={...}
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {
+    'message', 'asctime', 'request_id', 'sample', 'taskName'
+}
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record, including the request id and any extra fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        request_id = getattr(record, 'request_id', None)
+        if request_id:
+            entry['request_id'] = request_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class RequestIdFilter(logging.Filter):
+    """Stamp records with the current request id (must run in the logging thread)"""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Keep only ``rate`` of the sub-WARNING records logged with extra={'sample': True}"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, 'sample', False) and record.levelno < logging.WARNING:
+            return random.random() < self.rate
+        return True
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that (re)starts its listener thread in whichever process uses it.
+
+    Records are formatted here, in the caller's thread, so the request id and
+    exception text are captured; the listener thread only writes them out.
+    """
+
+    def __init__(self, target):
+        super().__init__(queue.SimpleQueue())
+        self.target = target
+        self._listener = None
+        self._listener_pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid != os.getpid():
+                # Listener threads don't survive fork; start one for this process
+                self.queue = queue.SimpleQueue()
+                self._listener = logging.handlers.QueueListener(self.queue, self.target)
+                self._listener.start()
+                self._listener_pid = os.getpid()
+
+    def emit(self, record):
+        self._ensure_listener()
+        super().emit(record)
+
+    def stop(self):
+        if self._listener is not None and self._listener_pid == os.getpid():
+            self._listener.stop()
+            self._listener_pid = None
+
+_handler = None
+
+def setup_logging(level=None, sample_rate=None):
+    """Send all logging through a non-blocking queue to JSON lines on stdout.
+
+    ``level`` defaults to LOG_LEVEL (INFO) and ``sample_rate`` to
+    LOG_SAMPLE_RATE (0.1). Calling it again is a no-op.
+    """
+    global _handler
+    if _handler is not None:
+        return
+    if level is None:
+        level = os.getenv('LOG_LEVEL', 'INFO').upper()
+    if sample_rate is None:
+        sample_rate = float(os.getenv('LOG_SAMPLE_RATE', '0.1'))
+
+    target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(logging.Formatter('%(message)s'))
+
+    _handler = _QueueHandler(target)
+    _handler.addFilter(SamplingFilter(sample_rate))
+    _handler.addFilter(RequestIdFilter())
+    _handler.setFormatter(JSONFormatter())
+
+    root = logging.getLogger()
+    root.handlers = [_handler]
+    root.setLevel(level)
+    atexit.register(_handler.stop)
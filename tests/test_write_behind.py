@@ -0,0 +1,126 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from write_behind import WriteBehindBuffer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeFlush:
+    """A flush_func that records each batch and fails while ``failing`` is set"""
+
+    def __init__(self):
+        self.batches = []
+        self.attempts = []
+        self.failing = False
+
+    def __call__(self, records):
+        self.attempts.append(list(records))
+        if self.failing:
+            raise RuntimeError("flush failed")
+        self.batches.append(list(records))
+
+
+@pytest.fixture
+def flushed():
+    return FakeFlush()
+
+
+@pytest.fixture
+def make_buffer(tmp_path, flushed):
+    buffers = []
+
+    def make():
+        # A long interval keeps the background flusher out of the way; tests flush explicitly
+        buffer = WriteBehindBuffer(flushed, str(tmp_path), 'events', max_batch=1000, flush_interval=3600)
+        buffers.append(buffer)
+        return buffer
+
+    yield make
+    flushed.failing = False
+    for buffer in buffers:
+        buffer.close()
+
+
+def write_segment(spill_dir, pid, records, nonce='0badf00d'):
+    path = os.path.join(spill_dir, f"events-{pid}-{nonce}-0.log")
+    with open(path, 'w', encoding='utf-8') as segment:
+        segment.writelines(json.dumps(record) + '\n' for record in records)
+    return path
+
+
+def segments(spill_dir):
+    """Spill segments that still hold records"""
+    return sorted(name for name in os.listdir(spill_dir) if os.path.getsize(os.path.join(spill_dir, name)))
+
+
+def test_records_from_a_crashed_process_are_replayed(tmp_path, make_buffer, flushed):
+    script = textwrap.dedent(f"""
+        import os, sys
+        sys.path.insert(0, {ROOT!r})
+        from write_behind import WriteBehindBuffer
+        buffer = WriteBehindBuffer(lambda records: None, {str(tmp_path)!r}, 'events', flush_interval=3600)
+        buffer.add({{'n': 1}})
+        buffer.add({{'n': 2}})
+        os._exit(0)
+    """)
+    subprocess.run([sys.executable, '-c', script], check=True)
+    assert len(segments(tmp_path)) == 1
+
+    buffer = make_buffer()
+    buffer.add({'n': 3})
+    assert buffer.pending() == 3
+    buffer.flush()
+
+    assert flushed.batches == [[{'n': 1}, {'n': 2}], [{'n': 3}]]
+    assert segments(tmp_path) == []
+
+
+def test_segments_from_an_earlier_run_with_the_same_pid_are_replayed(tmp_path, make_buffer, flushed):
+    # After a container restart the new process can be given the pid the old one had
+    write_segment(str(tmp_path), os.getpid(), [{'n': 1}])
+
+    buffer = make_buffer()
+    buffer.add({'n': 2})
+    buffer.flush()
+
+    assert flushed.batches == [[{'n': 1}], [{'n': 2}]]
+    assert segments(tmp_path) == []
+
+
+def test_segments_of_a_live_process_are_left_alone(tmp_path, make_buffer, flushed):
+    path = write_segment(str(tmp_path), os.getppid(), [{'n': 1}])
+
+    buffer = make_buffer()
+    buffer.add({'n': 2})
+    buffer.flush()
+
+    assert flushed.batches == [[{'n': 2}]]
+    assert os.path.exists(path)
+
+
+def test_failed_batches_are_retried_in_order(tmp_path, make_buffer, flushed):
+    buffer = make_buffer()
+    flushed.failing = True
+    buffer.add({'n': 1})
+    buffer.flush()
+    buffer.add({'n': 2})
+    buffer.flush()
+
+    # The second flush stops at the first failed batch instead of skipping past it
+    assert flushed.attempts == [[{'n': 1}], [{'n': 1}]]
+    assert buffer.pending() == 2
+    assert len(segments(tmp_path)) == 2
+
+    flushed.failing = False
+    buffer.add({'n': 3})
+    buffer.flush()
+
+    assert flushed.batches == [[{'n': 1}], [{'n': 2}], [{'n': 3}]]
+    assert buffer.pending() == 0
+    assert segments(tmp_path) == []
@@ -0,0 +1,168 @@
+import glob
+import json
+import logging
+import os
+import secrets
+import threading
+
+logger = logging.getLogger(__name__)
+
+class WriteBehindBuffer:
+    """Queue records in memory, spill them to disk, and flush them in batches.
+
+    Every record is appended to an on-disk spill log before ``add`` returns, so
+    records survive a crash before their flush. A background thread calls
+    ``flush_func(records)`` when ``max_batch`` records are waiting or
+    ``flush_interval`` seconds have passed. Each batch's log segment is
+    deleted only after ``flush_func`` succeeds; failed batches are retried on
+    the next flush. Segment names carry the pid and a per-start nonce, and
+    every segment not written by this process instance (a dead process, or
+    an earlier run that got the same pid after a restart) is replayed on
+    start, so ``flush_func`` must be idempotent.
+    """
+
+    def __init__(self, flush_func, spill_dir, name, max_batch=500, flush_interval=2.0):
+        self.flush_func = flush_func
+        self.spill_dir = spill_dir
+        self.name = name
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._records = []
+        self._failed = []  # (segment path, records) batches awaiting retry
+        self._segment = 0
+        self._log = None
+        self._thread = None
+        self._pid = None
+        self._nonce = None
+
+    def _segment_path(self, segment):
+        return os.path.join(self.spill_dir, f"{self.name}-{self._pid}-{self._nonce}-{segment}.log")
+
+    def _ensure_started(self):
+        # Called with self._lock held. Threads don't survive fork, so each
+        # process starts its own flusher and spill log the first time it is used.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._nonce = secrets.token_hex(4)
+        self._records = []
+        self._failed = []
+        self._segment = 0
+        self._stopping.clear()
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self._recover_orphans()
+        self._log = open(self._segment_path(self._segment), 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name=f"{self.name}-flusher", daemon=True)
+        self._thread.start()
+
+    def _recover_orphans(self):
+        """Queue segments from process instances that exited before flushing them"""
+        orphans = sorted(glob.glob(os.path.join(self.spill_dir, f"{self.name}-*-*.log")))
+        for number, path in enumerate(orphans):
+            try:
+                pid = int(os.path.basename(path)[len(self.name) + 1:].split('-')[0])
+            except ValueError:
+                continue
+            # This runs before our first segment is opened, so a segment with
+            # our pid is from an earlier run that was given the same pid, e.g.
+            # after a container restart, and is recovered like any other.
+            if pid != self._pid and _process_alive(pid):
+                continue
+
+            # Rename to claim the segment so no other process replays it too.
+            # The new name is one of ours, so it is recovered again if we die.
+            claimed = self._segment_path(f"recovered{number}")
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            with open(claimed, encoding='utf-8') as segment:
+                records = [json.loads(line) for line in segment if line.strip()]
+            logger.warning("Recovered unflushed %s records", self.name,
+                           extra={'records': len(records), 'segment': os.path.basename(path)})
+            self._failed.append((claimed, records))
+
+    def add(self, record):
+        """Queue a JSON-serializable record; it is on disk when this returns"""
+        with self._lock:
+            self._ensure_started()
+            self._log.write(json.dumps(record) + '\n')
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._records.append(record)
+            pending = len(self._records)
+        if pending >= self.max_batch:
+            self._wakeup.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._records) + sum(len(records) for _, records in self._failed)
+
+    def _swap(self):
+        """Hand the current records and log segment to the flusher and start a new segment"""
+        with self._lock:
+            if not self._records:
+                return
+            self._log.close()
+            batch = (self._segment_path(self._segment), self._records)
+            self._segment += 1
+            self._log = open(self._segment_path(self._segment), 'a', encoding='utf-8')
+            self._records = []
+            self._failed.append(batch)
+
+    def flush(self):
+        """Write every queued record through flush_func"""
+        with self._flush_lock:
+            self._swap()
+            with self._lock:
+                batches, self._failed = self._failed, []
+
+            for index, (path, records) in enumerate(batches):
+                try:
+                    self.flush_func(records)
+                except Exception:
+                    logger.exception("Error flushing %s records, will retry", self.name,
+                                     extra={'records': len(records)})
+                    with self._lock:
+                        self._failed = batches[index:] + self._failed
+                    return
+                os.remove(path)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self, timeout=10):
+        """Stop the flusher and drain everything still queued"""
+        if self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+                # Drop the empty segment opened by the last swap
+                path = self._segment_path(self._segment)
+                if os.path.exists(path) and os.path.getsize(path) == 0:
+                    os.remove(path)
+            self._pid = None
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True